@@ -0,0 +1,321 @@
+"""End-to-end benchmarks of k8s-gitsync against stub kubectl and helm.
+
+Synthetic repositories are generated for each size, and k8s_gitsync.main.main runs in a child process
+for each scenario, against the stub kubectl or the stub API server (--k8s-client api). The wall time,
+the number of kubectl/helm processes (and API requests), the peak RSS of the main process and the time of
+each phase are reported as JSON, to be compared between the commits.
+
+    python benchmarks/run.py --sizes 100,1000 --latency 0.05 --output bench.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+DOCUMENTS_PER_FILE = 4
+DOCUMENTS_PER_NAMESPACE = 200
+# the fraction of the manifests changed before dry-run, and removed before clean
+CHANGE_RATIO = 0.1
+
+# scenario: (description, main arguments)
+SCENARIOS = {
+    "sync": ("apply all manifests to an empty cluster", []),
+    "resync": ("sync again, nothing changed", []),
+    "dry-run": ("check the changed manifests", ["--dry-run"]),
+    "clean": ("delete the objects removed from the manifests", ["--clean"]),
+}
+
+_KINDS = ["ConfigMap", "Service", "Deployment", "Secret"]
+
+# runs in the child process, the peak RSS is of the main process only, not of kubectl/helm
+_CHILD = """
+import sys, json, resource
+out, args = sys.argv[1], sys.argv[2:]
+sys.argv = ["k8s-gitsync"] + args
+from k8s_gitsync import main
+rc = 0
+try:
+    main.main()
+except SystemExit as e:
+    rc = e.code if isinstance(e.code, int) else 1
+finally:
+    with open(out, "w") as f:
+        json.dump({"rc": rc, "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, f)
+"""
+
+
+def _manifest(kind, namespace, name, generation):
+    metadata = {
+        "name": name,
+        "namespace": namespace,
+        "annotations": {"k8s-gitsync/requires": f"namespace.default.{namespace}"},
+    }
+    if kind == "ConfigMap":
+        return {"apiVersion": "v1", "kind": kind, "metadata": metadata, "data": {"key": f"{name}-{generation}"}}
+    if kind == "Secret":
+        return {"apiVersion": "v1", "kind": kind, "metadata": metadata, "stringData": {"key": f"{name}-{generation}"}}
+    if kind == "Service":
+        spec = {"selector": {"app": name}, "ports": [{"port": 80, "targetPort": 8000 + generation}]}
+        return {"apiVersion": "v1", "kind": kind, "metadata": metadata, "spec": spec}
+    container = {"name": "app", "image": f"example/app:{generation}", "env": [{"name": "NAME", "value": name}]}
+    spec = {
+        "replicas": 1,
+        "selector": {"matchLabels": {"app": name}},
+        "template": {"metadata": {"labels": {"app": name}}, "spec": {"containers": [container]}},
+    }
+    return {"apiVersion": "apps/v1", "kind": kind, "metadata": metadata, "spec": spec}
+
+
+def _write_documents(path, documents):
+    # JSON is a subset of YAML, the generated repository does not depend on the YAML emitter
+    with open(path, "w") as f:
+        f.write("---\n".join(json.dumps(d, indent=2) + "\n" for d in documents))
+
+
+def generate_repo(repo_dir, documents, helm_releases):
+    """Generate a repository of the given number of k8s documents (including the namespaces) and helm releases.
+
+    Returns the paths of the k8s files other than the namespaces, changed and removed by the scenarios.
+    """
+    namespaces = [f"ns-{i:03}" for i in range(max(1, documents // DOCUMENTS_PER_NAMESPACE))]
+    os.makedirs(os.path.join(repo_dir, "namespaces"))
+    for namespace in namespaces:
+        manifest = {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": namespace}}
+        _write_documents(os.path.join(repo_dir, "namespaces", f"{namespace}.yaml"), [manifest])
+
+    files = []
+    objects = [(i, namespaces[i % len(namespaces)]) for i in range(documents - len(namespaces))]
+    for start in range(0, len(objects), DOCUMENTS_PER_FILE):
+        chunk = objects[start : start + DOCUMENTS_PER_FILE]
+        directory = os.path.join(repo_dir, "apps", chunk[0][1])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"app-{start // DOCUMENTS_PER_FILE:05}.yaml")
+        _write_documents(path, [_manifest(_KINDS[i % len(_KINDS)], ns, f"obj-{i:05}", 0) for i, ns in chunk])
+        files.append((path, chunk))
+
+    os.makedirs(os.path.join(repo_dir, "helm"))
+    for i in range(helm_releases):
+        stem = os.path.join(repo_dir, "helm", f"release-{i:03}")
+        namespace = namespaces[i % len(namespaces)]
+        with open(stem + ".helm", "w") as f:
+            f.write(f"name: release-{i:03}\nnamespace: {namespace}\n")
+            f.write("chart:\n  name: app\n  version: 1.0.0\n  repo: https://charts.example.com\n")
+            f.write(f"requires: namespace.default.{namespace}\n")
+        with open(stem + ".values.yaml", "w") as f:
+            f.write(f"replicas: 1\nimage:\n  tag: '{i}'\n")
+    return files
+
+
+def _change_files(files, generation):
+    for path, chunk in files:
+        _write_documents(path, [_manifest(_KINDS[i % len(_KINDS)], ns, f"obj-{i:05}", generation) for i, ns in chunk])
+
+
+def _parse_metrics(path):
+    # e.g. kgs_phase_duration_seconds_sum{phase="walk"} 0.012
+    phases, resources = {}, Counter()
+    if not os.path.exists(path):
+        return phases, {}
+    with open(path) as f:
+        for line in f:
+            m = re.match(r'kgs_phase_duration_seconds_sum\{phase="([^"]+)"\} (\S+)', line)
+            if m:
+                phases[m.group(1)] = round(float(m.group(2)), 4)
+            m = re.match(r'kgs_resources_total\{applier="([^"]+)",result="([^"]+)"\} (\S+)', line)
+            if m:
+                resources[f"{m.group(1)}.{m.group(2)}"] += int(float(m.group(3)))
+    return phases, dict(resources)
+
+
+def _read_from(path, offset):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        f.seek(offset)
+        return [line.strip() for line in f]
+
+
+def run_main(work_dir, name, args, env):
+    stub_log = os.path.join(work_dir, f"{name}.commands")
+    # the requests to the stub API server, which runs for all scenarios, are appended to a shared log
+    api_log = os.path.join(work_dir, "api.commands")
+    api_log_offset = os.path.getsize(api_log) if os.path.exists(api_log) else 0
+    result_path = os.path.join(work_dir, f"{name}.result.json")
+    metrics_path = os.path.join(work_dir, f"{name}.prom")
+    env = dict(env, STUB_LOG=stub_log)
+    cmd = [sys.executable, "-c", _CHILD, result_path, *args, "--metrics-textfile", metrics_path]
+
+    with open(os.path.join(work_dir, f"{name}.log"), "w") as log:
+        started = time.monotonic()
+        subprocess.run(cmd, cwd=work_dir, env=env, stdout=log, stderr=log, check=False)
+        wall = time.monotonic() - started
+
+    with open(result_path) as f:
+        child = json.load(f)
+    commands = Counter(_read_from(stub_log, 0) + _read_from(api_log, api_log_offset))
+    phases, resources = _parse_metrics(metrics_path)
+    return {
+        "exit_code": child["rc"],
+        "wall_seconds": round(wall, 4),
+        "peak_rss_kb": child["peak_rss_kb"],
+        "subprocesses": sum(commands.values()),
+        "subprocesses_by_command": dict(sorted(commands.items())),
+        "phases_seconds": phases,
+        "resources": resources,
+    }
+
+
+def _install_stubs(bin_dir):
+    os.makedirs(bin_dir)
+    for command in ("kubectl", "helm"):
+        path = os.path.join(bin_dir, command)
+        with open(path, "w") as f:
+            f.write(f"#!{sys.executable}\n")
+            f.write(f"import sys\nsys.path.insert(0, {BENCH_DIR!r})\nimport stub\nstub.main({command!r})\n")
+        os.chmod(path, 0o755)
+
+
+def _start_api_server(work_dir, env):
+    # returns the server process and the kubeconfig to connect to it
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "stub_api.py")],
+        env=dict(env, STUB_LOG=os.path.join(work_dir, "api.commands")),
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    port = int(server.stdout.readline())
+    kubeconfig = os.path.join(work_dir, "kubeconfig")
+    config = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [{"name": "stub", "cluster": {"server": f"http://127.0.0.1:{port}"}}],
+        "users": [{"name": "stub", "user": {}}],
+        "contexts": [{"name": "stub", "context": {"cluster": "stub", "user": "stub"}}],
+        "current-context": "stub",
+    }
+    with open(kubeconfig, "w") as f:
+        json.dump(config, f)
+    return server, kubeconfig
+
+
+def bench_size(work_dir, documents, conf):
+    repo_dir = os.path.join(work_dir, "repo")
+    files = generate_repo(repo_dir, documents, conf.helm_releases)
+
+    bin_dir = os.path.join(work_dir, "bin")
+    _install_stubs(bin_dir)
+    env = dict(
+        os.environ,
+        PATH=bin_dir + os.pathsep + os.environ["PATH"],
+        PYTHONPATH=ROOT_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        STUB_STATE=os.path.join(work_dir, "cluster"),
+        STUB_LATENCY=str(conf.latency),
+        XDG_CACHE_HOME=os.path.join(work_dir, "cache"),
+    )
+    common_args = [repo_dir, "--jobs", str(conf.jobs), *conf.main_args]
+    if conf.max_procs is not None:
+        common_args += ["--max-procs", str(conf.max_procs)]
+
+    server = None
+    if conf.k8s_client == "api":
+        server, env["KUBECONFIG"] = _start_api_server(work_dir, env)
+        common_args += ["--k8s-client", "api"]
+
+    results = []
+    changed = files[: max(1, int(len(files) * CHANGE_RATIO))]
+    try:
+        for scenario in conf.scenarios:
+            if scenario == "dry-run":
+                _change_files(changed, 1)
+            if scenario == "clean":
+                for path, _ in changed:
+                    os.remove(path)
+
+            print(f"running {scenario} with {documents} documents..", file=sys.stderr)
+            result = run_main(work_dir, scenario, common_args + SCENARIOS[scenario][1], env)
+            results.append(
+                {"scenario": scenario, "documents": documents, "helm_releases": conf.helm_releases, **result}
+            )
+            if result["exit_code"] != 0:
+                print(f"  exited with {result['exit_code']}, see {work_dir}/{scenario}.log", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark k8s-gitsync end to end against stub kubectl and helm")
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated numbers of k8s documents")
+    parser.add_argument("--helm-releases", type=int, default=20, help="number of helm releases")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each kubectl/helm command takes")
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help=f"comma separated scenarios run in order ({', '.join(SCENARIOS)})",
+    )
+    parser.add_argument(
+        "--k8s-client",
+        choices=["kubectl", "api"],
+        default="kubectl",
+        help="--k8s-client of k8s-gitsync (api: against the stub API server, benchmarks/stub_api.py)",
+    )
+    parser.add_argument("--jobs", type=int, default=4, help="--jobs of k8s-gitsync")
+    parser.add_argument("--max-procs", type=int, default=None, help="--max-procs of k8s-gitsync")
+    parser.add_argument("--main-args", default="", help="extra arguments of k8s-gitsync (e.g. '--no-cache')")
+    parser.add_argument("--work-dir", default=None, help="directory to keep the repositories and logs")
+    parser.add_argument("--output", default=None, help="file to write the results (default: stdout)")
+    conf = parser.parse_args()
+    conf.scenarios = conf.scenarios.split(",")
+    conf.main_args = conf.main_args.split()
+    unknown = set(conf.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {sorted(unknown)}")
+
+    work_root = conf.work_dir or tempfile.mkdtemp(prefix="kgs-bench-")
+    results = []
+    try:
+        for documents in [int(s) for s in conf.sizes.split(",")]:
+            work_dir = os.path.join(work_root, str(documents))
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.makedirs(work_dir)
+            results += bench_size(work_dir, documents, conf)
+    finally:
+        if conf.work_dir is None:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "latency": conf.latency,
+            "k8s_client": conf.k8s_client,
+            "jobs": conf.jobs,
+            "max_procs": conf.max_procs,
+            "main_args": conf.main_args,
+        },
+        "results": results,
+    }
+    if conf.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(conf.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""Stub kubectl and helm for the benchmarks.
+
+Only the commands and outputs used by k8s-gitsync are implemented. The cluster is an in-memory dict,
+loaded from and saved to JSON files for each command because every command is a new process.
+
+Environments:
+* STUB_STATE: directory of the cluster state
+* STUB_LOG: file to append the command name and verb of each run
+* STUB_LATENCY: seconds to sleep in each command, as the round trip to the API server
+* STUB_WATCH_INTERVAL: seconds between the polls of the state by 'kubectl get --watch' (default: 0.5)
+* STUB_KUBECTL_VERSION: version of kubectl to behave as (default: 1.20.0), e.g. 1.16.0 for the older outputs
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+CLUSTER_KINDS = {"namespace", "clusterrole", "customresourcedefinition"}
+API_RESOURCES = [
+    ("configmaps", "cm", "v1", "true", "ConfigMap"),
+    ("namespaces", "ns", "v1", "false", "Namespace"),
+    ("secrets", "", "v1", "true", "Secret"),
+    ("services", "svc", "v1", "true", "Service"),
+    ("deployments", "deploy", "apps/v1", "true", "Deployment"),
+    ("clusterroles", "", "rbac.authorization.k8s.io/v1", "false", "ClusterRole"),
+]
+# the commands only read the state, they run concurrently
+READ_VERBS = {"version", "config", "api-resources", "get", "list"}
+# options followed by a value
+_VALUE_OPTIONS = {
+    "-n",
+    "--namespace",
+    "-l",
+    "--selector",
+    "-o",
+    "--output",
+    "-f",
+    "--values",
+    "--version",
+    "--repo",
+    "--raw",
+}
+
+
+class State:
+    """Objects are stored in a file for each namespace, a command loads only the namespaces it touches."""
+
+    def __init__(self, state_dir, exclusive=True):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self._lock = open(os.path.join(state_dir, "lock"), "w")
+        fcntl.flock(self._lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        meta = self._load("meta", {})
+        self.namespaces = meta.get("namespaces", ["default", "kube-system"])
+        self.releases = meta.get("releases", {})
+        self.resource_version = meta.get("resourceVersion", 0)
+        self._shards = {}
+        self._dirty = set()
+
+    def close(self):
+        self._lock.close()
+
+    def _path(self, name):
+        return os.path.join(self.state_dir, name + ".json")
+
+    def _load(self, name, default):
+        try:
+            with open(self._path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def objects(self, namespace):
+        # namespace: "" for the cluster scoped objects
+        if namespace not in self._shards:
+            self._shards[namespace] = self._load("objects." + namespace, {})
+        return self._shards[namespace]
+
+    def all_objects(self):
+        for name in os.listdir(self.state_dir):
+            if name.startswith("objects."):
+                self.objects(name[len("objects.") : -len(".json")])
+        return [obj for shard in self._shards.values() for obj in shard.values()]
+
+    def get(self, obj):
+        namespace, key = _object_key(obj)
+        return self.objects(namespace).get(key)
+
+    def put(self, obj):
+        namespace, key = _object_key(obj)
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        self.objects(namespace)[key] = obj
+        self._dirty.add(namespace)
+
+    def remove(self, obj):
+        namespace, key = _object_key(obj)
+        del self.objects(namespace)[key]
+        self._dirty.add(namespace)
+
+    def save(self):
+        shards = {"objects." + ns: self._shards[ns] for ns in self._dirty}
+        shards["meta"] = {
+            "namespaces": self.namespaces,
+            "releases": self.releases,
+            "resourceVersion": self.resource_version,
+        }
+        for name, data in shards.items():
+            with open(self._path(name) + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(self._path(name) + ".tmp", self._path(name))
+        self._dirty.clear()
+
+
+def _parse_args(args):
+    options, positionals = {}, []
+    args = iter(args)
+    for arg in args:
+        if arg in _VALUE_OPTIONS:
+            options[arg] = next(args, "")
+        elif arg.startswith("-"):
+            key, _, value = arg.partition("=")
+            options[key] = value or True
+        else:
+            positionals.append(arg)
+    return options, positionals
+
+
+def _fail(message):
+    sys.stderr.write(message + "\n")
+    return 1
+
+
+def _object_key(obj):
+    kind = obj["kind"].lower()
+    namespace = "" if kind in CLUSTER_KINDS else obj["metadata"].get("namespace", "default")
+    return namespace, f'{kind}/{obj["metadata"]["name"]}'
+
+
+def _kind_matches(obj, kind_arg):
+    # kind_arg: "<kind>", "<kind>.<version>.<group>" or "<plural>"
+    kind = kind_arg.split(".")[0].lower()
+    return obj["kind"].lower() in (kind, kind.rstrip("s"))
+
+
+def _select(state, kind_args, namespace, selector):
+    label_key, _, label_value = (selector or "").partition("=")
+    if namespace is None:
+        objects = state.all_objects()
+    else:
+        objects = [*state.objects(namespace).values(), *state.objects("").values()]
+    items = []
+    for obj in objects:
+        if not any(_kind_matches(obj, k) for k in kind_args):
+            continue
+        if label_key and (obj["metadata"].get("labels") or {}).get(label_key) != label_value:
+            continue
+        items.append(obj)
+    return items
+
+
+def _jsonpath_rows(items, template):
+    # only '{range .items[*]}{.a.b}{"\t"}{.c['key']}{"\n"}{end}' used by the metadata-only list is supported
+    def _get(obj, path):
+        for plain, quoted in re.findall(r"([^.\[\]']+)|\['([^']+)'\]", path):
+            obj = obj.get(plain or quoted) if isinstance(obj, dict) else None
+        return "" if obj is None else str(obj)
+
+    fields = [f for f in re.findall(r"\{\.([^}]+)\}", template) if not f.startswith("items")]
+    return "".join("\t".join(_get(obj, f) for f in fields) + "\n" for obj in items)
+
+
+def _kubectl_version():
+    version = os.environ.get("STUB_KUBECTL_VERSION", "1.20.0")
+    return version, tuple(int(v) for v in version.split(".")[:2])
+
+
+def _api_groups():
+    groups = sorted({r[2].rpartition("/")[0] for r in API_RESOURCES} - {""})
+    versions = {r[2].rpartition("/")[0]: r[2] for r in API_RESOURCES}
+    return [{"name": g, "preferredVersion": {"groupVersion": versions[g]}} for g in groups]
+
+
+def _watch(state, kind_args, selector):
+    # the state is polled without holding the lock, and the differences are printed as the watch events
+    state.close()
+    known = {}
+    while True:
+        state = State(state.state_dir, exclusive=False)
+        current = {_object_key(obj): obj for obj in _select(state, kind_args, None, selector)}
+        state.close()
+        events = [("DELETED", obj) for key, obj in known.items() if key not in current]
+        for key, obj in current.items():
+            if key not in known:
+                events.append(("ADDED", obj))
+            elif obj["metadata"].get("resourceVersion") != known[key]["metadata"].get("resourceVersion"):
+                events.append(("MODIFIED", obj))
+        # NOTE: kubectl prints the events as concatenated and indented JSON objects
+        for event_type, obj in events:
+            print(json.dumps({"type": event_type, "object": obj}, indent=4), flush=True)
+        known = current
+        time.sleep(float(os.environ.get("STUB_WATCH_INTERVAL", "0.5")))
+
+
+def kubectl(args, state):
+    options, positionals = _parse_args(args)
+    verb = positionals[0] if positionals else ""
+    namespace = options.get("-n", options.get("--namespace", "default"))
+    output = options.get("-o", options.get("--output"))
+    version, minor_version = _kubectl_version()
+
+    if verb == "version":
+        major, minor = version.split(".")[:2]
+        if output == "json":
+            print(json.dumps({"clientVersion": {"major": major, "minor": minor, "gitVersion": f"v{version}"}}))
+        else:
+            print(f"Client Version: v{version}\nServer Version: v{version}")
+        return 0
+    if verb == "config":
+        print("https://stub:6443", end="")
+        return 0
+    if verb == "api-resources":
+        row = "{:<16}{:<12}{:<32}{:<12}{}"
+        if minor_version >= (1, 20):
+            print(row.format("NAME", "SHORTNAMES", "APIVERSION", "NAMESPACED", "KIND"))
+            for resource in API_RESOURCES:
+                print(row.format(*resource))
+        else:
+            # the group only, empty for the core group
+            print(row.format("NAME", "SHORTNAMES", "APIGROUP", "NAMESPACED", "KIND"))
+            for name, short_names, api_version, namespaced, kind in API_RESOURCES:
+                print(row.format(name, short_names, api_version.rpartition("/")[0], namespaced, kind))
+        return 0
+    if verb == "get" and options.get("--raw") == "/apis":
+        print(json.dumps({"kind": "APIGroupList", "groups": _api_groups()}))
+        return 0
+    if verb == "create" and positionals[1:2] == ["namespace"]:
+        name = positionals[2]
+        if name in state.namespaces:
+            return _fail(f'Error from server (AlreadyExists): namespaces "{name}" already exists')
+        state.namespaces.append(name)
+        state.save()
+        print(f"namespace/{name} created")
+        return 0
+    if verb == "get" and "--watch" in options:
+        return _watch(state, positionals[1].split(","), options.get("-l"))
+    if verb == "get":
+        if positionals[1] in ("namespaces", "namespace", "ns"):
+            items = [{"kind": "Namespace", "metadata": {"name": n}} for n in state.namespaces]
+        else:
+            all_namespaces = "--all-namespaces" in options or "-A" in options
+            items = _select(state, positionals[1].split(","), None if all_namespaces else namespace, options.get("-l"))
+        names = positionals[2:]
+        if names:
+            items = [obj for obj in items if obj["metadata"]["name"] in names]
+            if not items:
+                return _fail(f'Error from server (NotFound): {positionals[1]} "{names[0]}" not found')
+        if output == "json":
+            print(json.dumps(items[0] if names else {"apiVersion": "v1", "kind": "List", "items": items}))
+        elif output == "jsonpath={.items[*].metadata.name}":
+            print(" ".join(obj["metadata"]["name"] for obj in items), end="")
+        elif output and output.startswith("jsonpath="):
+            sys.stdout.write(_jsonpath_rows(items, output))
+        else:
+            print("\n".join(f'{obj["kind"].lower()}/{obj["metadata"]["name"]}' for obj in items))
+        return 0
+    if verb == "apply":
+        if minor_version < (1, 18) and ("--server-side" in options or options.get("--dry-run") == "server"):
+            return _fail('error: invalid argument "server" for "--dry-run" flag: strconv.ParseBool: parsing "server"')
+        rc = 0
+        for manifest in yaml.load_all(sys.stdin, Loader=SafeLoader):
+            if not manifest:
+                continue
+            if manifest["kind"].lower() not in CLUSTER_KINDS:
+                ns = manifest["metadata"].setdefault("namespace", namespace)
+                if ns not in state.namespaces:
+                    rc = _fail(f'Error from server (NotFound): namespaces "{ns}" not found')
+                    continue
+            elif manifest["kind"] == "Namespace" and manifest["metadata"]["name"] not in state.namespaces:
+                state.namespaces.append(manifest["metadata"]["name"])
+            # the resourceVersion in a manifest is a precondition, and an unchanged object is not updated
+            current = state.get(manifest)
+            resource_version = manifest["metadata"].pop("resourceVersion", None)
+            if current is not None:
+                current_version = current["metadata"].pop("resourceVersion")
+                if resource_version is not None and resource_version != current_version:
+                    rc = _fail(
+                        f'Error from server (Conflict): Operation cannot be fulfilled on {manifest["kind"].lower()} '
+                        f'"{manifest["metadata"]["name"]}": the object has been modified'
+                    )
+                    continue
+                is_changed = current != manifest
+                current["metadata"]["resourceVersion"] = current_version
+            if current is None or is_changed:
+                state.put(manifest)
+            print(f'{manifest["kind"].lower()}/{manifest["metadata"]["name"]}')
+        # --dry-run=server: validated only, not persisted
+        if options.get("--dry-run") != "server":
+            state.save()
+        return rc
+    if verb == "delete":
+        names = set(positionals[2:])
+        for obj in _select(state, [positionals[1]], namespace, None):
+            if obj["metadata"]["name"] in names:
+                state.remove(obj)
+                print(f'{obj["kind"].lower()}/{obj["metadata"]["name"]}')
+        state.save()
+        return 0
+    return _fail(f"stub kubectl: unsupported command: {args}")
+
+
+def helm(args, state):
+    options, positionals = _parse_args(args)
+    verb = positionals[0] if positionals else ""
+    namespace = options.get("-n", options.get("--namespace", "default"))
+
+    if verb == "version":
+        print("v3.3.4+gstub")
+        return 0
+    if verb == "list":
+        releases = state.releases.values()
+        print(json.dumps([{**r, "revision": str(r["revision"]), "status": "deployed"} for r in releases]))
+        return 0
+    if verb == "get" and positionals[1:2] == ["values"]:
+        release = state.releases.get(f"{namespace}/{positionals[2]}")
+        if release is None:
+            return _fail("Error: release: not found")
+        print(json.dumps(release["values"] or None))
+        return 0
+    if verb in ("install", "upgrade"):
+        name, chart = positionals[1], positionals[2].rsplit("/", 1)[-1]
+        key = f"{namespace}/{name}"
+        if verb == "install" and key in state.releases:
+            return _fail("Error: cannot re-use a name that is still in use")
+        if namespace not in state.namespaces:
+            return _fail(f'Error: create: failed to create: namespaces "{namespace}" not found')
+        revision = state.releases.get(key, {}).get("revision", 0) + 1
+        state.releases[key] = {
+            "name": name,
+            "namespace": namespace,
+            "chart": f'{chart}-{options.get("--version")}',
+            "values": yaml.load(sys.stdin, Loader=SafeLoader) or {},
+            "revision": revision,
+        }
+        state.save()
+        print(json.dumps({"name": name, "namespace": namespace, "version": revision, "info": {"status": "deployed"}}))
+        return 0
+    if verb in ("delete", "uninstall"):
+        for name in positionals[1:]:
+            if state.releases.pop(f"{namespace}/{name}", None) is not None:
+                print(f'release "{name}" uninstalled')
+        state.save()
+        return 0
+    return _fail(f"stub helm: unsupported command: {args}")
+
+
+def main(command):
+    args = sys.argv[1:]
+    _, positionals = _parse_args(args)
+    verb = positionals[0] if positionals else ""
+    if "STUB_LOG" in os.environ:
+        # NOTE: a short line is written at once by O_APPEND, the concurrent commands do not mix up the lines
+        with open(os.environ["STUB_LOG"], "a") as f:
+            f.write(f"{command} {verb}\n")
+    time.sleep(float(os.environ.get("STUB_LATENCY", "0")))
+
+    state = State(os.environ["STUB_STATE"], exclusive=verb not in READ_VERBS)
+    handler = {"kubectl": kubectl, "helm": helm}[command]
+    sys.exit(handler(args, state))
@@ -0,0 +1,249 @@
+"""Stub k8s API server for the benchmarks of --k8s-client api.
+
+Only the requests sent by k8s_gitsync.kube_api are served: discovery, paged and metadata only lists,
+get, server-side apply (with dryRun), delete and watch. The cluster state is the same files as stub.py,
+so the stub kubectl and helm can be used against the same cluster.
+
+    python benchmarks/stub_api.py [--port PORT]
+
+The port is printed on the first line of stdout when the server is ready.
+
+Environments:
+* STUB_STATE: directory of the cluster state
+* STUB_LOG: file to append "api <method>" of each request
+* STUB_LATENCY: seconds to sleep in each request, as the round trip to the API server
+* STUB_WATCH_INTERVAL: seconds between the polls of the state by the watch requests (default: 0.5)
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stub
+
+# /api/v1[/namespaces/<namespace>]/<plural>[/<name>], the same under /apis/<group>/<version>
+_PATH_PATTERN = re.compile(
+    r"^/(?:api/(?P<core>v1)|apis/(?P<group>[^/]+)/(?P<version>[^/]+))"
+    r"(?:/namespaces/(?P<namespace>[^/]+))?/(?P<plural>[^/]+)(?:/(?P<name>[^/]+))?$"
+)
+# (api_version, plural) -> (kind, namespaced)
+_RESOURCES = {(r[2], r[0]): (r[4], r[3] == "true") for r in stub.API_RESOURCES}
+
+
+def _status(code, reason, message):
+    return code, {"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": reason, "message": message}
+
+
+def _resource_list(api_version):
+    resources = []
+    for name, short_names, resource_api_version, namespaced, kind in stub.API_RESOURCES:
+        if resource_api_version == api_version:
+            verbs = ["create", "delete", "get", "list", "patch", "update", "watch"]
+            resource = {"name": name, "namespaced": namespaced == "true", "kind": kind, "verbs": verbs}
+            if short_names:
+                resource["shortNames"] = [short_names]
+            resources.append(resource)
+    return {"kind": "APIResourceList", "groupVersion": api_version, "resources": resources}
+
+
+def _select(state, api_version, kind, namespace, selector):
+    items = stub._select(state, [kind], namespace, selector)
+    if kind == "Namespace" and not selector:
+        # the namespaces created by 'create namespace' are not stored as the objects
+        names = {obj["metadata"]["name"] for obj in items}
+        items += [{"metadata": {"name": n}} for n in state.namespaces if n not in names]
+    return [{"apiVersion": api_version, "kind": kind, **obj} for obj in items]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        if "STUB_LOG" in os.environ:
+            with open(os.environ["STUB_LOG"], "a") as f:
+                f.write(f"api {method}\n")
+        time.sleep(float(os.environ.get("STUB_LATENCY", "0")))
+
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = None
+        if "Content-Length" in self.headers:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"null")
+
+        if method == "GET" and params.get("watch") == "true":
+            return self._watch(url.path, params)
+        state = stub.State(os.environ["STUB_STATE"], exclusive=method != "GET")
+        try:
+            code, response = self._dispatch(state, method, url.path, params, body)
+        finally:
+            state.close()
+        self._send(code, response)
+
+    def _dispatch(self, state, method, path, params, body):
+        if path == "/version":
+            return 200, {"major": "1", "minor": "20", "gitVersion": "v1.20.0"}
+        if path == "/apis":
+            return 200, {"kind": "APIGroupList", "groups": stub._api_groups()}
+        if path == "/api/v1":
+            return 200, _resource_list("v1")
+        m = re.match(r"^/apis/([^/]+)/([^/]+)$", path)
+        if m:
+            return 200, _resource_list(f"{m.group(1)}/{m.group(2)}")
+
+        m = _PATH_PATTERN.match(path)
+        if m is None:
+            return _status(404, "NotFound", f"the server could not find the requested resource: {path}")
+        api_version = m.group("core") or f'{m.group("group")}/{m.group("version")}'
+        if (api_version, m.group("plural")) not in _RESOURCES:
+            return _status(404, "NotFound", f"the server could not find the requested resource: {path}")
+        kind, namespaced = _RESOURCES[(api_version, m.group("plural"))]
+        namespace = unquote(m.group("namespace")) if namespaced and m.group("namespace") else None
+        name = unquote(m.group("name")) if m.group("name") else None
+
+        if method == "GET" and name is None:
+            return self._list(state, api_version, kind, namespace, params)
+        if method == "GET":
+            for obj in _select(state, api_version, kind, namespace or "", None):
+                if obj["metadata"]["name"] == name:
+                    return 200, obj
+            return _status(404, "NotFound", f'{m.group("plural")} "{name}" not found')
+        if method == "POST" and kind == "Namespace":
+            if body["metadata"]["name"] in state.namespaces:
+                return _status(409, "AlreadyExists", f'namespaces "{body["metadata"]["name"]}" already exists')
+            state.namespaces.append(body["metadata"]["name"])
+            state.save()
+            return 201, body
+        if method == "PATCH":
+            return self._apply(state, namespace, body, params)
+        if method == "DELETE":
+            obj = state.get({"kind": kind, "metadata": {"name": name, "namespace": namespace}})
+            if obj is None:
+                return _status(404, "NotFound", f'{m.group("plural")} "{name}" not found')
+            state.remove(obj)
+            state.save()
+            return 200, {"kind": "Status", "apiVersion": "v1", "status": "Success"}
+        return _status(405, "MethodNotAllowed", f"{method} is not supported by the stub")
+
+    def _list(self, state, api_version, kind, namespace, params):
+        items = _select(state, api_version, kind, namespace, params.get("labelSelector"))
+        # the continue token is the offset of the next page
+        offset, limit = int(params.get("continue") or 0), int(params.get("limit") or len(items) or 1)
+        page, next_offset = items[offset : offset + limit], offset + limit
+        list_kind = f"{kind}List"
+        if "as=PartialObjectMetadataList" in self.headers.get("Accept", ""):
+            list_kind = "PartialObjectMetadataList"
+            page = [{"kind": "PartialObjectMetadata", "metadata": obj["metadata"]} for obj in page]
+        metadata = {"continue": str(next_offset)} if next_offset < len(items) else {}
+        return 200, {"kind": list_kind, "apiVersion": api_version, "metadata": metadata, "items": page}
+
+    def _apply(self, state, namespace, manifest, params):
+        metadata = manifest["metadata"]
+        if manifest["kind"].lower() not in stub.CLUSTER_KINDS:
+            metadata["namespace"] = namespace
+            if namespace not in state.namespaces:
+                return _status(404, "NotFound", f'namespaces "{namespace}" not found')
+        elif manifest["kind"] == "Namespace" and metadata["name"] not in state.namespaces:
+            state.namespaces.append(metadata["name"])
+
+        # the resourceVersion in a manifest is a precondition, and an unchanged object is not updated
+        current = state.get(manifest)
+        resource_version = metadata.pop("resourceVersion", None)
+        code = 201
+        if current is not None:
+            current_version = current["metadata"].pop("resourceVersion")
+            is_changed = current != manifest
+            current["metadata"]["resourceVersion"] = current_version
+            if resource_version is not None and resource_version != current_version:
+                return _status(
+                    409,
+                    "Conflict",
+                    f'Operation cannot be fulfilled on {manifest["kind"].lower()} "{metadata["name"]}": '
+                    "the object has been modified",
+                )
+            code = 200
+            if not is_changed:
+                return code, current
+        state.put(manifest)
+        if params.get("dryRun") != "All":
+            state.save()
+        return code, manifest
+
+    def _watch(self, path, params):
+        m = _PATH_PATTERN.match(path + "/_")
+        key = (m.group("core") or f'{m.group("group")}/{m.group("version")}', m.group("plural")) if m else None
+        if key not in _RESOURCES:
+            return self._send(*_status(404, "NotFound", f"the server could not find the requested resource: {path}"))
+
+        # the events are sent a line for each, until the timeout or the client disconnects
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        deadline = time.monotonic() + int(params.get("timeoutSeconds", "60"))
+        known = {}
+        while time.monotonic() < deadline:
+            state = stub.State(os.environ["STUB_STATE"], exclusive=False)
+            items = _select(state, key[0], _RESOURCES[key][0], None, params.get("labelSelector"))
+            state.close()
+            current = {stub._object_key(obj): obj for obj in items}
+            events = [("DELETED", obj) for k, obj in known.items() if k not in current]
+            for k, obj in current.items():
+                if k not in known:
+                    events.append(("ADDED", obj))
+                elif obj["metadata"].get("resourceVersion") != known[k]["metadata"].get("resourceVersion"):
+                    events.append(("MODIFIED", obj))
+            try:
+                for event_type, obj in events:
+                    self.wfile.write(json.dumps({"type": event_type, "object": obj}).encode() + b"\n")
+                self.wfile.flush()
+            except OSError:
+                return
+            known = current
+            time.sleep(float(os.environ.get("STUB_WATCH_INTERVAL", "0.5")))
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stub k8s API server")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on (default: any free port)")
+    conf = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", conf.port), Handler)
+    server.daemon_threads = True
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+from .resource import Resource
+from . import log
+
+logger = log.getLogger(__name__)
+
+# NOTE: bump this when the expanded resources (e.g. hash algorithm) are changed
+CACHE_VERSION = 3
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "k8s-gitsync")
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _file_digest(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ManifestCache:
+    # expanded resources of each manifest file (and its values files) are kept in pickle files,
+    # and looked up by the path, size and mtime, or by the content digest when the file is touched.
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.pickle")
+        self.entry_dir = os.path.join(cache_dir, "entries")
+        os.makedirs(self.entry_dir, exist_ok=True)
+
+        self.index = {}
+        try:
+            with open(self.index_path, "rb") as f:
+                index = pickle.load(f)
+            if index.get("version") == CACHE_VERSION:
+                self.index = index["entries"]
+        except (OSError, EOFError, pickle.UnpicklingError):
+            logger.info(f"creating a new manifest cache in {cache_dir}")
+        self.hits, self.misses = 0, 0
+        # key: (stats, digest) of the files looked up and not found, until they are stored
+        self.pending = {}
+
+    def _load(self, record):
+        try:
+            with open(os.path.join(self.entry_dir, record["entry"]), "rb") as f:
+                entries = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return [Resource(**dict(zip(Resource.FIELDS, e))) for e in entries]
+
+    def _store(self, key, stats, digest, resources):
+        entries = [tuple(getattr(r, name) for name in Resource.FIELDS) for r in resources]
+        data = pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)
+        entry = hashlib.sha256(repr(key).encode()).hexdigest() + ".pickle"
+        _atomic_write(os.path.join(self.entry_dir, entry), data)
+        self.index[key] = {"stats": stats, "digest": digest, "entry": entry, "size": len(data), "atime": time.time()}
+
+    def lookup(self, resource):
+        # returns the cached resources, or None to be expanded and stored
+        paths = [resource.manifest] + list(resource.values)
+        key = (resource.applier, tuple(paths))
+        stats = [(s.st_size, s.st_mtime_ns) for s in map(os.stat, paths)]
+
+        record = self.index.get(key)
+        digest = None
+        if record is not None and record["stats"] != stats:
+            digest = _file_digest(paths)
+            if record["digest"] != digest:
+                record = None
+
+        resources = self._load(record) if record is not None else None
+        if resources is not None:
+            self.hits += 1
+            record["stats"], record["atime"] = stats, time.time()
+            return resources
+
+        self.misses += 1
+        self.pending[key] = (stats, digest or _file_digest(paths))
+        return None
+
+    def store(self, resource, resources):
+        # NOTE: stored before the resources are changed (e.g. annotated on apply)
+        key = (resource.applier, tuple([resource.manifest] + list(resource.values)))
+        stats, digest = self.pending.pop(key)
+        self._store(key, stats, digest, resources)
+
+    def save(self):
+        # evict the least recently used entries over the size limit
+        total = sum(r["size"] for r in self.index.values())
+        for key, record in sorted(self.index.items(), key=lambda e: e[1]["atime"]):
+            if total <= self.max_bytes:
+                break
+            total -= record["size"]
+            del self.index[key]
+
+        entries = {r["entry"] for r in self.index.values()}
+        for name in os.listdir(self.entry_dir):
+            if name.endswith(".pickle") and name not in entries:
+                os.unlink(os.path.join(self.entry_dir, name))
+
+        index = {"version": CACHE_VERSION, "entries": self.index}
+        _atomic_write(self.index_path, pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL))
+        logger.info(f"manifest cache: {self.hits} hits, {self.misses} misses, {total} bytes")
@@ -0,0 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from . import log
+
+logger = log.getLogger(__name__)
+
+
+def _run_task(fn, args):
+    with log.grouped():
+        return fn(*args)
+
+
+class LevelExecutor:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+
+    def run(self, tasks):
+        # every task of the level must be finished before returning, so the next level can rely on them
+        futures = [self.pool.submit(_run_task, fn, args) for fn, args in tasks]
+        wait(futures)
+        return [f.result() for f in futures]
+
+    def split(self, items):
+        chunks = [items[i :: self.jobs] for i in range(self.jobs)]
+        return [c for c in chunks if c]
+
+    def shutdown(self):
+        self.pool.shutdown()
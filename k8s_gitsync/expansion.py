@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from .resource import Resource
+from . import k8s
+from . import helm
+from . import log
+
+logger = log.getLogger(__name__)
+
+# below this size of the files to parse, starting the worker processes costs more than parsing them in process
+POOL_MIN_BYTES = 1024 * 1024
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+def _expand_fn(applier):
+    if applier == "k8s":
+        return k8s.expand_multi_document_file
+    return helm.expand
+
+
+def _expand_in_worker(task):
+    # runs in the worker process, the expanded resources are sent back as the tuples of Resource.FIELDS
+    applier, manifest, values, with_content = task
+    entries = []
+    for r in _expand_fn(applier)(Resource(applier, manifest, values=values)):
+        entry = [getattr(r, name) for name in Resource.FIELDS]
+        # NOTE: the content which can be loaded again is not sent back, when it is dropped anyway
+        if not with_content and r.applier in Resource.loaders:
+            entry[Resource.FIELDS.index("content")] = None
+        entries.append(tuple(entry))
+    return entries
+
+
+def _file_size(resource):
+    return sum(os.path.getsize(p) for p in [resource.manifest] + list(resource.values))
+
+
+def _expand_files(resources, workers, with_content):
+    if workers <= 1 or len(resources) <= 1 or sum(map(_file_size, resources)) < POOL_MIN_BYTES:
+        return [_expand_fn(r.applier)(r) for r in resources]
+
+    workers = min(workers, len(resources))
+    logger.info(f"expanding {len(resources)} manifest files in {workers} processes")
+    tasks = [(r.applier, r.manifest, r.values, with_content) for r in resources]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # the results are in the order of the files, the same as expanded in process
+        results = pool.map(_expand_in_worker, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+        return [[Resource(**dict(zip(Resource.FIELDS, e))) for e in entries] for entries in results]
+
+
+def expand(resources, manifest_cache=None, low_memory=False, workers=1):
+    """Expands the manifest files into the resources, in the order of the files.
+
+    The files not found in the manifest cache are parsed and hashed in the worker processes,
+    or in process when they are too small to be worth starting the workers.
+    """
+    expanded = [None] * len(resources)
+    if manifest_cache is not None:
+        for i, resource in enumerate(resources):
+            expanded[i] = manifest_cache.lookup(resource)
+    misses = [i for i, e in enumerate(expanded) if e is None]
+
+    # the content is needed to be stored in the cache, even if it is dropped
+    with_content = manifest_cache is not None or not low_memory
+    for i, result in zip(misses, _expand_files([resources[i] for i in misses], workers, with_content)):
+        if manifest_cache is not None:
+            manifest_cache.store(resources[i], result)
+        expanded[i] = result
+
+    expanded_resources = []
+    for result in expanded:
+        if low_memory:
+            # the ids, hashes and metadata are kept, the changed ones are loaded again to be applied
+            for r in result:
+                r.drop_content()
+        expanded_resources.extend(result)
+    return expanded_resources
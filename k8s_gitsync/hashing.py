@@ -0,0 +1,56 @@
+import hashlib
+import datetime
+
+# NOTE: prefixed to tell the canonical hash from the legacy one (sha256 of yaml.dump) in the annotations
+CANONICAL_HASH_PREFIX = "c1:"
+
+
+def _token(update, tag, payload):
+    # the payload length is included, so that the adjacent tokens can not be confused
+    update(tag)
+    update(str(len(payload)).encode())
+    update(b":")
+    update(payload)
+
+
+def _update(update, data, path, exclude):
+    if data is None:
+        update(b"n")
+    elif data is True:
+        update(b"t")
+    elif data is False:
+        update(b"f")
+    elif isinstance(data, str):
+        _token(update, b"s", data.encode())
+    elif isinstance(data, int):
+        _token(update, b"i", str(data).encode())
+    elif isinstance(data, float):
+        _token(update, b"r", repr(data).encode())
+    elif isinstance(data, dict):
+        keys = [k for k in data if path + (k,) not in exclude] if exclude else list(data)
+        _token(update, b"m", str(len(keys)).encode())
+        # keys are sorted with the type, because YAML mapping keys are not always strings
+        for key in sorted(keys, key=lambda k: (type(k).__name__, str(k))):
+            _update(update, key, (), ())
+            _update(update, data[key], path + (key,) if exclude else path, exclude)
+    elif isinstance(data, (list, tuple)):
+        _token(update, b"l", str(len(data)).encode())
+        for i, e in enumerate(data):
+            _update(update, e, path + (i,) if exclude else path, exclude)
+    elif isinstance(data, (datetime.date, datetime.datetime)):
+        _token(update, b"d", data.isoformat().encode())
+    elif isinstance(data, bytes):
+        _token(update, b"b", data)
+    elif isinstance(data, (set, frozenset)):
+        _token(update, b"S", str(len(data)).encode())
+        for e in sorted(data, key=lambda e: (type(e).__name__, str(e))):
+            _update(update, e, (), ())
+    else:
+        _token(update, b"o", f"{type(data).__name__}:{data!r}".encode())
+
+
+def canonical_hash(data, exclude=()):
+    # exclude: key paths (tuples of keys) not to be hashed, e.g. [("metadata", "annotations")]
+    digest = hashlib.sha256()
+    _update(digest.update, data, (), set(map(tuple, exclude)))
+    return CANONICAL_HASH_PREFIX + digest.hexdigest()
@@ -1,8 +1,12 @@
 import re
-import yaml
 import json
-import hashlib
+import gzip
+import base64
 from . import utils
+from . import yaml_codec
+from . import hashing
+from . import metrics
+from . import tracing
 from . import log
 
 logger = log.getLogger(__name__)
@@ -14,12 +18,22 @@ class HelmV2Client:
     def __init__(self, helm_binary_path="./helm3/helm"):
         self.helm_binary_path = helm_binary_path
 
-    def get_values(self, namespace, release_name):
-        cmd = [self.helm_binary_path, "get", "values", release_name, "--output", "json"]
-        outs, _, _ = utils.cmd_exec(cmd)
+    def _get_values_cmd(self, namespace, release_name):
+        return [self.helm_binary_path, "get", "values", release_name, "--output", "json"]
+
+    def _parse_values(self, outs):
         values = json.loads(outs.decode())
         return values
 
+    def get_values(self, namespace, release_name):
+        outs, _, _ = utils.cmd_exec(self._get_values_cmd(namespace, release_name))
+        return self._parse_values(outs)
+
+    def get_values_all(self, releases):
+        # releases: list of (namespace, release_name), fetched concurrently
+        results = utils.cmd_exec_all([(self._get_values_cmd(ns, name), None) for ns, name in releases])
+        return [self._parse_values(outs) for outs, _, _ in results]
+
     def get_release_list(self):
         cmd = [self.helm_binary_path, "list", "--output", "json"]
         outs, _, _ = utils.cmd_exec(cmd)
@@ -31,14 +45,19 @@ class HelmV2Client:
         release_list = json.loads(outs.decode())
 
         def _rename_key(helm_release):
-            for from_key, to_key in [("Name", "name"), ("Chart", "chart"), ("Namespace", "namespace")]:
+            for from_key, to_key in [
+                ("Name", "name"),
+                ("Chart", "chart"),
+                ("Namespace", "namespace"),
+                ("Revision", "revision"),
+            ]:
                 if from_key in helm_release:
                     helm_release[to_key] = helm_release[from_key]
             return helm_release
 
         return [_rename_key(e) for e in release_list["Releases"]]
 
-    def upgrade_install_release(self, namespace, release_name, repo, localpath, chart_name, version, values):
+    def upgrade_install_release(self, namespace, release_name, repo, localpath, chart_name, version, values, installed):
         cmd = []
         cmd += [self.helm_binary_path, "upgrade"]
         cmd += ["--output", "json"]
@@ -66,16 +85,18 @@ class HelmV2Client:
 
         return json.loads(outs_json)
 
-    def delete_release(self, namespace, release_name):
-        cmd = [self.helm_binary_path, "delete", "--purge", release_name]
-        outs, errs, rc = utils.cmd_exec(cmd)
+    def _delete_cmd(self, namespace, release_names):
+        return [self.helm_binary_path, "delete", "--purge", *release_names]
 
-        if rc != 0:
-            logger.error("failed to execute helm upgrade --install")
-            logger.error(f"stdout: {outs.decode()}")
-            logger.error(f"stderr: {errs.decode()}")
-
-        return
+    def delete_releases(self, batches):
+        # batches: list of (namespace, release_names), a command for each batch run concurrently
+        results = utils.cmd_exec_all([(self._delete_cmd(ns, names), None) for ns, names in batches])
+        for outs, errs, rc in results:
+            if rc != 0:
+                logger.error("failed to execute helm delete")
+                logger.error(f"stdout: {outs.decode()}")
+                logger.error(f"stderr: {errs.decode()}")
+        return [rc == 0 for _, _, rc in results]
 
 
 class HelmV3Client(HelmV2Client):
@@ -83,25 +104,21 @@ class HelmV3Client(HelmV2Client):
         super().__init__(helm_binary_path)
         self.helm_binary_path = helm_binary_path
 
-    def _ensure_namespace(self, namespace):
-        cmd = ["kubectl", "create", "namespace", namespace]
-        utils.cmd_exec(cmd)
-
     def get_release_list(self):
         cmd = [self.helm_binary_path, "list", "--output", "json", "--all-namespaces"]
         outs, _, _ = utils.cmd_exec(cmd)
         return json.loads(outs.decode())
 
-    def get_values(self, namespace, release_name):
-        cmd = [self.helm_binary_path, "-n", namespace, "get", "values", release_name, "--output", "json"]
-        outs, _, _ = utils.cmd_exec(cmd)
+    def _get_values_cmd(self, namespace, release_name):
+        return [self.helm_binary_path, "-n", namespace, "get", "values", release_name, "--output", "json"]
+
+    def _parse_values(self, outs):
         values = json.loads(outs.decode())
         if values is None:
             return {}
         return values
 
     def _install_release(self, namespace, release_name, repo, localpath, chart_name, version, values):
-        self._ensure_namespace(namespace)
         cmd = []
         cmd += [self.helm_binary_path, "install"]
         cmd += [release_name]
@@ -131,7 +148,6 @@ class HelmV3Client(HelmV2Client):
         return json.loads(outs_json)
 
     def _upgrade_release(self, namespace, release_name, repo, localpath, chart_name, version, values):
-        self._ensure_namespace(namespace)
         cmd = []
         cmd += [self.helm_binary_path, "upgrade"]
         cmd += ["--output", "json"]
@@ -159,25 +175,16 @@ class HelmV3Client(HelmV2Client):
 
         return json.loads(outs_json)
 
-    def _is_installed(self, release_name, namespace):
-        release_list = self.get_release_list()
-        for e in release_list:
-            if e["namespace"] == namespace and e["name"] == release_name:
-                return True
-        return False
-
-    def upgrade_install_release(self, namespace, release_name, repo, localpath, chart_name, version, values):
-        # check installed or not
+    def upgrade_install_release(self, namespace, release_name, repo, localpath, chart_name, version, values, installed):
+        # check installed or not (by the caller's release state)
         # because values from stdin not fully supported yet on v3.0.0 (#7002)
-        if self._is_installed(release_name, namespace):
+        if installed:
             return self._upgrade_release(namespace, release_name, repo, localpath, chart_name, version, values)
         else:
             return self._install_release(namespace, release_name, repo, localpath, chart_name, version, values)
 
-    def delete_release(self, namespace, release_name):
-        cmd = [self.helm_binary_path, "delete", "-n", namespace, release_name]
-        outs, _, _ = utils.cmd_exec(cmd)
-        return
+    def _delete_cmd(self, namespace, release_names):
+        return [self.helm_binary_path, "delete", "-n", namespace, *release_names]
 
 
 class HelmClient:
@@ -185,6 +192,7 @@ class HelmClient:
         self.helm_binary_path = helm_binary_path
 
         v, _, _ = self._get_helm_version()
+        self.major_version = v
         if v == 2:
             self.client = HelmV2Client(self.helm_binary_path)
         if v == 3:
@@ -200,24 +208,24 @@ class HelmClient:
     def get_values(self, namespace, release_name):
         return self.client.get_values(namespace, release_name)
 
+    def get_values_all(self, releases):
+        return self.client.get_values_all(releases)
+
     def get_release_list(self):
         return self.client.get_release_list()
 
-    def upgrade_install_release(self, namespace, release_name, repo, localpath, chart_name, version, values):
+    def upgrade_install_release(self, namespace, release_name, repo, localpath, chart_name, version, values, installed):
         return self.client.upgrade_install_release(
-            namespace, release_name, repo, localpath, chart_name, version, values
+            namespace, release_name, repo, localpath, chart_name, version, values, installed
         )
 
-    def delete_release(self, namespace, release_name):
-        return self.client.delete_release(namespace, release_name)
+    def delete_releases(self, batches):
+        return self.client.delete_releases(batches)
 
 
 def _calc_helm_values_hash(values_dict):
-    # deep clone and remove managed key
-    values = json.loads(json.dumps(values_dict))
-    values.pop(KGS_MANAGED_KEY, None)
-    json_str = json.dumps(values, sort_keys=True)
-    return hashlib.sha256(json_str.encode()).hexdigest()
+    # the managed key is not a part of values
+    return hashing.canonical_hash(values_dict, exclude=[(KGS_MANAGED_KEY,)])
 
 
 def _safe_get(d, *args, default=None):
@@ -236,18 +244,89 @@ def _hash_head(s):
     return s[:8]
 
 
-def _get_state(helm_client):
+# the statuses of the latest revisions listed by 'helm list' by default (e.g. not uninstalled with --keep-history)
+LISTED_STATUSES = {"deployed", "failed"}
+
+
+def _decode_release(data):
+    # release secret data is base64 encoded by k8s, then base64 encoded and gzipped by helm
+    release = base64.b64decode(base64.b64decode(data))
+    if release[:3] == b"\x1f\x8b\x08":
+        release = gzip.decompress(release)
+    return json.loads(release)
+
+
+def _get_state_from_secrets(k8s_client):
+    secrets = k8s_client.list("v1", "Secret", None, "owner=helm")
+    if secrets is None:
+        logger.error("failed to fetch helm release secrets")
+        return None
+
+    # a release exists while its latest revision is listed by 'helm list' (e.g. the first install failed),
+    # and its values are of the latest deployed revision, so that a failed upgrade is not taken as applied
+    latest, deployed = {}, {}
+    for secret in secrets:
+        labels = secret["metadata"].get("labels", {})
+        key = (secret["metadata"]["namespace"], labels["name"])
+        revision = int(labels.get("version", 0))
+        if key not in latest or latest[key][0] < revision:
+            latest[key] = (revision, secret)
+        if labels.get("status") == "deployed" and (key not in deployed or deployed[key][0] < revision):
+            deployed[key] = (revision, secret)
+
+    # decode only one revision of each release
+    state = {}
+    for (namespace, name), (revision, secret) in latest.items():
+        if secret["metadata"].get("labels", {}).get("status") not in LISTED_STATUSES:
+            continue
+        _, secret = deployed.get((namespace, name), (revision, secret))
+        release = _decode_release(secret["data"]["release"])
+        chart = release["chart"]["metadata"]
+        values = release.get("config") or {}
+        state[f"helm.{namespace}.{name}"] = {
+            "release_name": name,
+            "chart": f'{chart["name"]}-{chart["version"]}',
+            "namespace": namespace,
+            "revision": revision,
+            "_values_data": values,
+            "values_hash": _calc_helm_values_hash(values),
+        }
+    return state
+
+
+@tracing.traced()
+def get_state(helm_client, backend="helm", k8s_client=None):
+    # k8s_client: to fetch the release secrets by the secrets backend
+    if backend == "secrets":
+        if helm_client.major_version == 3:
+            state = _get_state_from_secrets(k8s_client)
+            if state is not None:
+                return state
+        else:
+            logger.warning("helm release secrets are only available with helm 3, fetching state by helm")
+        logger.info("fetching state by helm")
+
     release_list = helm_client.get_release_list()
+    values_list = helm_client.get_values_all([(e["namespace"], e["name"]) for e in release_list])
+    state = get_revisions(helm_client, release_list)
+    for e, values in zip(release_list, values_list):
+        state_id_str = f'helm.{e["namespace"]}.{e["name"]}'
+        state[state_id_str]["_values_data"] = values
+        state[state_id_str]["values_hash"] = _calc_helm_values_hash(values)
+    return state
+
+
+def get_revisions(helm_client, release_list=None):
+    # the releases without the values, by one helm list (e.g. to check the revisions are not changed)
+    if release_list is None:
+        release_list = helm_client.get_release_list()
     state = {}
     for e in release_list:
-        state_id_str = f'helm.{e["namespace"]}.{e["name"]}'
-        values = helm_client.get_values(e["namespace"], e["name"])
-        state[state_id_str] = {
+        state[f'helm.{e["namespace"]}.{e["name"]}'] = {
             "release_name": e["name"],
             "chart": e["chart"],
             "namespace": e["namespace"],
-            "_values_data": values,
-            "values_hash": _calc_helm_values_hash(values),
+            "revision": int(e["revision"]) if e.get("revision") is not None else None,
         }
     return state
 
@@ -257,11 +336,11 @@ def _get_values(value_files):
     if len(value_files) != 1:
         return {}
     else:
-        return yaml.safe_load(open(value_files[0]))
+        return yaml_codec.load(open(value_files[0]))
 
 
 def _get_manifest(resource):
-    manifest = yaml.safe_load(open(resource.manifest))
+    manifest = yaml_codec.load(open(resource.manifest))
     values = _get_values(resource.values)
 
     id_str = f'helm.{manifest["namespace"]}.{manifest["name"]}'
@@ -305,49 +384,101 @@ def _check_delete(state_dict, manifest_dict):
         logger.debug(f"    need to delete: {id_str not in manifest_dict}")
 
         if need_process:
-            yield id_str, state["namespace"], state["release_name"]
+            requires = _safe_get(state, "_values_data", KGS_MANAGED_KEY, "requires") or []
+            yield id_str, state["namespace"], state["release_name"], set(requires)
 
 
-def create_or_update(resource, is_dry_run):
-    helm_client = HelmClient()
-    state_dict = _get_state(helm_client)
-    manifest_dict = _get_manifest(resource)
+def namespaces_of(resources):
+    return {r.content["_manifest_data"]["namespace"] for r in resources}
 
-    if _check_create_or_upgrade(state_dict, manifest_dict):
-        manifest = manifest_dict["_manifest_data"]
-        values = manifest_dict["_values_data"]
 
-        values[KGS_MANAGED_KEY] = {"managed": True}
-        if is_dry_run:
-            logger.info("skipping install or upgrade a helm chart (dry-run)")
-        else:
-            helm_client.upgrade_install_release(
-                manifest["namespace"],
-                manifest["name"],
-                manifest["chart"].get("repo", None),
-                manifest["chart"].get("localpath", None),
-                manifest["chart"]["name"],
-                manifest["chart"]["version"],
-                yaml.safe_dump(values).encode(),
-            )
-
-
-def destroy_unless_exist_in(resources, is_dry_run):
-    helm_client = HelmClient()
-    state_dict = _get_state(helm_client)
-    manifests = [_get_manifest(r) for r in resources]
-    manifest_dict = {m["id"]: m for m in manifests}
-
-    for id_str, namespace, release_name in _check_delete(state_dict, manifest_dict):
-        if is_dry_run:
-            logger.info("skipping delete a helm chart (dry-run)")
-        else:
-            helm_client.delete_release(namespace, release_name)
+@tracing.traced(args=lambda resource, *_: {"id": resource.id})
+def create_or_update(resource, is_dry_run, helm_client, state_dict, namespace_registry):
+    manifest_dict = resource.content
+
+    metrics.inc("kgs_resources_total", applier="helm", result="checked")
+    if not _check_create_or_upgrade(state_dict, manifest_dict):
+        return []
+    metrics.inc("kgs_resources_total", applier="helm", result="changed")
+
+    manifest = manifest_dict["_manifest_data"]
+    values = manifest_dict["_values_data"]
+
+    # NOTE: requires are recorded, so that the releases are deleted before the resources they require
+    values[KGS_MANAGED_KEY] = {"managed": True, "requires": sorted(resource.requires)}
+    if is_dry_run:
+        logger.info("skipping install or upgrade a helm chart (dry-run)")
+        return []
+
+    namespace_registry.ensure([manifest["namespace"]])
+
+    result = helm_client.upgrade_install_release(
+        manifest["namespace"],
+        manifest["name"],
+        manifest["chart"].get("repo", None),
+        manifest["chart"].get("localpath", None),
+        manifest["chart"]["name"],
+        manifest["chart"]["version"],
+        yaml_codec.dump(values).encode(),
+        manifest_dict["id"] in state_dict,
+    )
+    if result is None:
+        metrics.inc("kgs_resources_total", applier="helm", result="failed")
+        return [resource]
+    metrics.inc("kgs_resources_total", applier="helm", result="applied")
+
+    # keep the run-scoped state up to date instead of listing the releases again
+    state_dict[manifest_dict["id"]] = {
+        "release_name": manifest["name"],
+        "chart": manifest_dict["chart"],
+        "namespace": manifest["namespace"],
+        "revision": result.get("version"),
+        "_values_data": values,
+        "values_hash": manifest_dict["values_hash"],
+    }
+    return []
+
+
+@tracing.traced()
+def find_stale(resources, state_dict):
+    manifest_dict = {r.content["id"]: r.content for r in resources}
+
+    return list(_check_delete(state_dict, manifest_dict))
+
+
+@tracing.traced(args=lambda releases, *_: {"ids": [r[0] for r in releases]})
+def destroy(releases, is_dry_run, helm_client, state_dict):
+    # releases: list of (id, namespace, release_name, requires)
+    if is_dry_run:
+        for id_str, _, _, _ in releases:
+            logger.info(f"skipping delete {id_str} (dry-run)")
+        return []
+
+    # the releases in the same namespace are deleted by one command
+    groups = {}
+    for id_str, namespace, release_name, _ in releases:
+        groups.setdefault(namespace, []).append((id_str, release_name))
+    if not groups:
+        return []
+
+    batches = [(namespace, [name for _, name in group]) for namespace, group in groups.items()]
+    failed = []
+    for group, is_deleted in zip(groups.values(), helm_client.delete_releases(batches)):
+        for id_str, _ in group:
+            if is_deleted:
+                state_dict.pop(id_str, None)
+            else:
+                failed.append(id_str)
+    metrics.inc("kgs_resources_total", len(releases) - len(failed), applier="helm", result="deleted")
+    metrics.inc("kgs_resources_total", len(failed), applier="helm", result="failed")
+    return failed
 
 
 def expand(resource):
     resource.content = _get_manifest(resource)
     resource.id = resource.content["id"]
+    resource.namespace = resource.content["_manifest_data"]["namespace"]
+    resource.name = resource.content["_manifest_data"]["name"]
     requires = resource.content["_manifest_data"].get("requires")
     if requires:
         if isinstance(requires, list):
@@ -0,0 +1,185 @@
+import os
+import json
+from . import utils
+from . import k8s
+from . import log
+
+logger = log.getLogger(__name__)
+
+STATE_VERSION = 1
+
+
+def _git(repo_dir, *args):
+    outs, errs, rc = utils.cmd_exec(["git", "-C", repo_dir, *args])
+    if rc != 0:
+        logger.warning(f"failed to execute git {' '.join(args)}: {errs.decode()}")
+        return None
+    return outs.decode()
+
+
+def _entry(resource):
+    entry = {"id": resource.id, "applier": resource.applier, "requires": sorted(resource.requires)}
+    if resource.applier == "k8s":
+        entry["apiVersion"] = resource.api_version
+        entry["kind"] = resource.kind
+    entry["name"] = resource.name
+    entry["namespace"] = resource.namespace
+    return entry
+
+
+def k8s_states(entries):
+    states = []
+    for e in entries:
+        if e["applier"] == "k8s":
+            metadata = {"name": e["name"]}
+            if e["namespace"] is not None:
+                metadata["namespace"] = e["namespace"]
+            if e["requires"]:
+                metadata["annotations"] = {k8s.KGS_REQUIRES_KEY: ",".join(e["requires"])}
+            states.append({"apiVersion": e["apiVersion"], "kind": e["kind"], "metadata": metadata})
+    return states
+
+
+def helm_releases(entries):
+    return [(e["id"], e["namespace"], e["name"], set(e["requires"])) for e in entries if e["applier"] == "helm"]
+
+
+class IncrementalSync:
+    # 'apply' and 'clean' runs keep their own last synced commit and the resources found in each file,
+    # so that a clean run can find what was removed since the last clean.
+    def __init__(self, repo_dir, state_file, mode):
+        self.repo_dir = repo_dir
+        self.state_file = state_file
+        self.mode = mode
+
+        self.state = {"version": STATE_VERSION}
+        if os.path.exists(state_file):
+            state = json.load(open(state_file))
+            if state.get("version") == STATE_VERSION:
+                self.state = state
+        self.last = self.state.get(mode)
+        # NOTE: a clean run also looks at the files recorded by the apply runs,
+        # not to miss the resources added and removed again between two clean runs
+        self.applied = self.state.get("apply") if mode == "clean" else None
+        if self.applied is not None and self.last is not None and self.last.get("applied") == self.applied["commit"]:
+            # already looked at by the last clean run
+            self.applied = None
+
+        head = _git(repo_dir, "rev-parse", "HEAD")
+        self.head = head.strip() if head is not None else None
+        self.changed, self.deleted = None, None
+        if self.head is not None and self.last is not None:
+            self._get_changes()
+        if self.is_full:
+            logger.info("no usable last synced commit, processing all manifest files")
+
+    @property
+    def is_full(self):
+        return self.changed is None
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.repo_dir)
+
+    def _get_changes(self):
+        # NOTE: -z not to quote the paths (e.g. non-ASCII), which would not match the manifest files
+        diff = _git(self.repo_dir, "diff", "--name-status", "-z", "--no-renames", "--relative", self.last["commit"])
+        untracked = _git(self.repo_dir, "ls-files", "-z", "--others", "--exclude-standard")
+        if diff is None or untracked is None:
+            return
+
+        changed, deleted = {p for p in untracked.split("\0") if p}, set()
+        fields = diff.split("\0")
+        for status, path in zip(fields[0::2], fields[1::2]):
+            if status == "D":
+                deleted.add(path)
+            else:
+                changed.add(path)
+        self.changed, self.deleted = changed, deleted
+        logger.info(f"changed since {self.last['commit'][:8]}: {sorted(changed)}, deleted: {sorted(deleted)}")
+
+    def _is_touched(self, path):
+        return path in self.changed or path in self.deleted
+
+    def select(self, files):
+        if self.is_full:
+            return files
+
+        # NOTE: a helm release must be processed when one of its values files is changed or removed
+        last_values = {path: entries[0].get("values", []) for path, entries in self.last["files"].items() if entries}
+        selected = []
+        for f in files:
+            paths = [self._relpath(f.manifest)] + [self._relpath(v) for v in f.values]
+            paths += last_values.get(paths[0], [])
+            if any(self._is_touched(p) for p in paths):
+                selected.append(f)
+        return selected
+
+    def select_dependents(self, files, resources):
+        if self.is_full:
+            return []
+
+        # resources requiring the changed ones (directly or not) are processed again
+        touched = {p for p in self.last["files"] if self._is_touched(p)}
+        changed_ids = {r.id for r in resources}
+        changed_ids |= {e["id"] for p in touched for e in self.last["files"][p]}
+
+        required_by = {}
+        file_of = {}
+        for path, entries in self.last["files"].items():
+            for e in entries:
+                file_of[e["id"]] = path
+                for required in e["requires"]:
+                    required_by.setdefault(required, set()).add(e["id"])
+
+        pending, dependent_ids = list(changed_ids), set()
+        while pending:
+            for dependent in required_by.get(pending.pop(), []):
+                if dependent not in dependent_ids and dependent not in changed_ids:
+                    dependent_ids.add(dependent)
+                    pending.append(dependent)
+
+        processed = {r.manifest for r in resources}
+        dependent_files = {file_of[i] for i in dependent_ids}
+        return [f for f in files if self._relpath(f.manifest) in dependent_files and f.manifest not in processed]
+
+    def removed(self, resources):
+        # the resources recorded in the processed files, but not found in them any more
+        if self.is_full:
+            return []
+
+        processed = {self._relpath(r.manifest) for r in resources} | self.changed | self.deleted
+        candidates = [e for p in processed for e in self.last["files"].get(p, [])]
+        if self.applied is not None:
+            # the files applied since the last clean, and removed before this one are not in the diff
+            for path, entries in self.applied["files"].items():
+                is_gone = path not in self.last["files"] and not os.path.exists(os.path.join(self.repo_dir, path))
+                if path in processed or is_gone:
+                    candidates += entries
+
+        ids = {r.id for r in resources}
+        removed = {}
+        for e in candidates:
+            if e["id"] not in ids:
+                removed.setdefault(e["id"], e)
+        return list(removed.values())
+
+    def save(self, resources):
+        if self.head is None:
+            return
+
+        files = {} if self.is_full else dict(self.last["files"])
+        if not self.is_full:
+            for path in {self._relpath(r.manifest) for r in resources} | self.changed | self.deleted:
+                files.pop(path, None)
+        for r in resources:
+            entry = _entry(r)
+            if r.applier == "helm":
+                entry["values"] = [self._relpath(v) for v in r.values]
+            files.setdefault(self._relpath(r.manifest), []).append(entry)
+
+        self.state[self.mode] = {"commit": self.head, "files": files}
+        if self.mode == "clean" and "apply" in self.state:
+            self.state[self.mode]["applied"] = self.state["apply"]["commit"]
+        with open(self.state_file, "w") as f:
+            json.dump(self.state, f)
+        logger.info(f"recorded the synced commit {self.head[:8]} to {self.state_file}")
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import hashlib
+from . import cache
+from . import log
+
+logger = log.getLogger(__name__)
+
+INVENTORY_NAME = "k8s-gitsync-inventory"
+INVENTORY_NS = "default"
+DEFAULT_DISCOVERY_TTL = 600
+
+
+def _group_kind(api_version, kind):
+    # NOTE: recorded without the version, the objects are still found after the preferred version is changed
+    return (api_version.rpartition("/")[0], kind)
+
+
+class Discovery:
+    # the kinds served by k8s are cached on disk for each cluster,
+    # because the discovery (e.g. 'kubectl api-resources') is slow on clusters with many CRDs.
+    def __init__(self, k8s_client, cache_dir=cache.DEFAULT_CACHE_DIR, ttl=DEFAULT_DISCOVERY_TTL):
+        self.k8s_client = k8s_client
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.kinds = None
+
+    def _cache_path(self):
+        if self.cache_dir is None:
+            return None
+        cluster_id = self.k8s_client.cluster_id()
+        if cluster_id is None:
+            return None
+        name = hashlib.sha256(cluster_id.encode()).hexdigest() + ".json"
+        return os.path.join(self.cache_dir, "discovery", name)
+
+    def get_kinds(self, refresh=False):
+        if self.kinds is not None and not refresh:
+            return self.kinds
+
+        path = self._cache_path()
+        if path is not None and not refresh:
+            try:
+                if time.time() - os.stat(path).st_mtime < self.ttl:
+                    with open(path) as f:
+                        self.kinds = [tuple(k) for k in json.load(f)]
+                    logger.info(f"using the cached resource kinds: {path}")
+                    return self.kinds
+            except (OSError, ValueError):
+                pass
+
+        logger.info("fetching resource kinds from k8s..")
+        self.kinds = list(self.k8s_client.get_kinds())
+        logger.info("fetched resource kinds from k8s.")
+        if path is not None and self.kinds:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cache._atomic_write(path, json.dumps(self.kinds).encode())
+        return self.kinds
+
+    def resolve(self, group_kinds):
+        # (group, kind) -> (api_version, kind) served by k8s, the kinds not served any more are dropped
+        served = {_group_kind(*k): k for k in self.get_kinds()}
+        if not set(group_kinds) <= set(served):
+            # the cache may be older than the CRDs
+            served = {_group_kind(*k): k for k in self.get_kinds(refresh=True)}
+        for group_kind in sorted(set(group_kinds) - set(served)):
+            logger.info(f"{group_kind} is not served by k8s any more, skipped")
+        return [served[k] for k in sorted(group_kinds) if k in served]
+
+
+def load(k8s_client, name=INVENTORY_NAME):
+    # returns None when the inventory is not recorded yet
+    state = k8s_client.get("v1", "ConfigMap", INVENTORY_NS, name)
+    if state is None:
+        return None
+    return {tuple(k) for k in json.loads((state.get("data") or {}).get("kinds", "[]"))}
+
+
+def save(k8s_client, group_kinds, name=INVENTORY_NAME):
+    manifest = {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": name, "namespace": INVENTORY_NS},
+        "data": {"kinds": json.dumps(sorted(group_kinds))},
+    }
+    # NOTE: not labeled as managed, not to be cleaned up
+    if k8s_client.apply([manifest])[0]:
+        logger.info(f"recorded {len(group_kinds)} kinds to the inventory")
+    else:
+        logger.error("failed to record the inventory")
+
+
+def extend(k8s_client, kinds, name=INVENTORY_NAME):
+    # kinds: (apiVersion, kind) of the applied objects
+    #
+    # NOTE:
+    # the inventory is created only by a full scan (see k8s.find_stale),
+    # otherwise the kinds applied before the inventory (and removed from the manifests) are never cleaned.
+    group_kinds = {_group_kind(api_version, kind) for api_version, kind in kinds}
+    if not group_kinds:
+        return
+    recorded = load(k8s_client, name)
+    if recorded is None or group_kinds <= recorded:
+        return
+    save(k8s_client, recorded | group_kinds, name)
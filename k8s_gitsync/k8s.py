@@ -1,8 +1,11 @@
-import json
-import yaml
 import hashlib
 from .resource import Resource
 from . import utils
+from . import yaml_codec
+from . import hashing
+from . import inventory
+from . import metrics
+from . import tracing
 from . import log
 
 logger = log.getLogger(__name__)
@@ -13,28 +16,24 @@ KGS_REQUIRES_KEY = "k8s-gitsync/requires"
 KGS_DEFAULT_NS = "default"
 
 
-def _ensure_namespace(namespace):
-    cmd = ["kubectl", "create", "namespace", namespace]
-    utils.cmd_exec(cmd)
-
-
-def _get_state(manifest):
-    namespace = manifest["metadata"].get("namespace", KGS_DEFAULT_NS)
-    name = manifest["metadata"]["name"]
-    kind = manifest["kind"]
-
-    cmd = ["kubectl", "-n", namespace, "get", kind, name, "-o", "json"]
-    outs, _, rc = utils.cmd_exec(cmd)
-    if rc != 0:
-        return None
-    else:
-        return json.loads(outs.decode())
+@tracing.traced()
+def get_state(k8s_client, resources):
+    groups = set()
+    for resource in resources:
+        groups.add((resource.api_version, resource.kind, resource.namespace or KGS_DEFAULT_NS))
 
+    logger.info(f"fetching {len(groups)} kinds and namespaces from k8s..")
+    queries = [(api_version, kind, ns, KGS_MANAGED_KEY + "=true") for api_version, kind, ns in sorted(groups)]
+    state_dict = {}
+    for states in k8s_client.list_many(queries):
+        # NOTE: the kind may not be served yet (e.g. CRD applied in this sync), treat as not installed.
+        for state in states or []:
+            state_dict[_k8s_resource_id(state["kind"], state["metadata"])] = state
+    logger.info("fetched states from k8s.")
+    return state_dict
 
-def _apply_manifest(manifest, filehash):
-    resource_id = _k8s_resource_id(manifest["kind"], manifest["metadata"])
-    logger.info(f"applying {resource_id}")
 
+def _annotate_manifest(manifest, filehash):
     if manifest["metadata"].get("annotations") is None:
         manifest["metadata"]["annotations"] = {}
     manifest["metadata"]["annotations"][LAST_APPLIED_KEY] = filehash
@@ -43,88 +42,210 @@ def _apply_manifest(manifest, filehash):
         manifest["metadata"]["labels"] = {}
     manifest["metadata"]["labels"][KGS_MANAGED_KEY] = "true"
 
-    _ensure_namespace(manifest["metadata"].get("namespace", KGS_DEFAULT_NS))
 
-    cmd = ["kubectl", "apply", "-f", "-"]
-    _, errs, _ = utils.cmd_exec(cmd, stdin=yaml.dump(manifest).encode())
-    if errs:
-        logger.error(f"failed to execute kubectl apply, {errs}")
-    else:
-        logger.info(f"applied {resource_id}")
+def namespaces_of(resources):
+    return {r.namespace or KGS_DEFAULT_NS for r in resources}
+
+
+@tracing.traced(args=lambda _, resources, *__: {"ids": [r.id for r in resources]})
+def _apply_manifests(k8s_client, resources, namespace_registry, is_dry_run=False):
+    for resource in resources:
+        logger.info(f"{'validating' if is_dry_run else 'applying'} {resource.id}")
+        _annotate_manifest(resource.content, resource.hash)
+
+    if not is_dry_run:
+        namespace_registry.ensure(namespaces_of(resources))
+
+    results = k8s_client.apply([r.content for r in resources], dry_run=is_dry_run)
+
+    failed = []
+    for resource, is_applied in zip(resources, results):
+        if is_applied:
+            logger.info(f"{'validated' if is_dry_run else 'applied'} {resource.id}")
+        else:
+            logger.error(f"failed to {'validate' if is_dry_run else 'apply'} {resource.id}")
+            failed.append(resource)
+    return failed
+
+
+def _documents(path):
+    with open(path) as f:
+        # some k8s manifest has empty document
+        return [document for document in yaml_codec.load_all(f) if document is not None]
 
 
 def expand_multi_document_file(resource):
-    with open(resource.manifest) as f:
-        documents = yaml.safe_load_all(f)
-
-        resources = []
-        for document in documents:
-            # some k8s manifest has empty document
-            if document is None:
-                continue
-            r = Resource("k8s", resource.manifest)
-            r.content = document
-            r.hash = hashlib.sha256(yaml.dump(document).encode()).hexdigest()
-            r.id = _k8s_resource_id(r.content["kind"], r.content["metadata"])
-            requires = r.content["metadata"].get("annotations", {}).get(KGS_REQUIRES_KEY)
-            if requires:
-                r.requires = set(requires.split(","))
-            resources.append(r)
+    resources = []
+    for i, document in enumerate(_documents(resource.manifest)):
+        metadata = document["metadata"]
+        r = Resource("k8s", resource.manifest, doc_index=i)
+        r.content = document
+        r.hash = hashing.canonical_hash(document)
+        r.id = _k8s_resource_id(document["kind"], metadata)
+        r.api_version, r.kind = document["apiVersion"], document["kind"]
+        r.namespace, r.name = metadata.get("namespace"), metadata["name"]
+        requires = (metadata.get("annotations") or {}).get(KGS_REQUIRES_KEY)
+        if requires:
+            r.requires = set(requires.split(","))
+        resources.append(r)
 
     return resources
 
 
-def create_or_update(resource, is_dry_run):
-    state = _get_state(resource.content)
+Resource.loaders["k8s"] = _documents
+
+
+def _legacy_hash(manifest):
+    return hashlib.sha256(yaml_codec.legacy_dump(manifest).encode()).hexdigest()
+
+
+def _is_applied_hash(resource, applied_hash):
+    if applied_hash is None:
+        return False
+    if applied_hash.startswith(hashing.CANONICAL_HASH_PREFIX):
+        return resource.hash == applied_hash
+    # NOTE: applied before the canonical hash, it is compared with the legacy hash not to re-apply everything
+    return _legacy_hash(resource.content) == applied_hash
+
 
-    if state is not None and resource.hash == state["metadata"].get("annotations", {}).get(LAST_APPLIED_KEY):
-        return
+def applied_hash(state):
+    return (state["metadata"].get("annotations") or {}).get(LAST_APPLIED_KEY)
+
+
+def _check_create_or_update(state_dict, resource):
+    state = state_dict.get(resource.id)
+
+    if state is not None:
+        if _is_applied_hash(resource, applied_hash(state)):
+            return False
 
     logger.info(f"{resource.id}: it will be installed or upgrade")
+    return True
+
+
+@tracing.traced(args=lambda resources, *_: {"ids": [r.id for r in resources]})
+def create_or_update(resources, is_dry_run, k8s_client, state_dict, namespace_registry):
+    # state_dict: None for server-side apply, the whole batch is sent and the server leaves the unchanged objects
+    metrics.inc("kgs_resources_total", len(resources), applier="k8s", result="checked")
+    if state_dict is not None:
+        resources = [r for r in resources if _check_create_or_update(state_dict, r)]
+        metrics.inc("kgs_resources_total", len(resources), applier="k8s", result="changed")
+    if not resources:
+        return []
 
     if is_dry_run:
-        logger.info("skipping install or upgrade a k8s resource (dry-run)")
-    else:
-        _apply_manifest(resource.content, resource.hash)
+        if state_dict is not None:
+            logger.info("skipping install or upgrade k8s resources (dry-run)")
+            return []
+        # NOTE: dry-run does not create the namespaces, the objects in the missing ones are rejected by the server
+        missing = namespace_registry.missing(namespaces_of(resources))
+        validated = []
+        for resource in resources:
+            namespace = resource.namespace or KGS_DEFAULT_NS
+            if namespace in missing:
+                logger.info(f"skipping validation of {resource.id}, namespace {namespace} does not exist yet")
+            else:
+                validated.append(resource)
+        resources = validated
+        if not resources:
+            return []
+        failed = _apply_manifests(k8s_client, resources, namespace_registry, is_dry_run=True)
+        metrics.inc("kgs_resources_total", len(resources) - len(failed), applier="k8s", result="validated")
+        metrics.inc("kgs_resources_total", len(failed), applier="k8s", result="failed")
+        return failed
+
+    failed = _apply_manifests(k8s_client, resources, namespace_registry)
+    metrics.inc("kgs_resources_total", len(resources) - len(failed), applier="k8s", result="applied")
+    metrics.inc("kgs_resources_total", len(failed), applier="k8s", result="failed")
+    return failed
 
 
 def _k8s_resource_id(kind, metadata):
     return f'{kind.lower()}.{metadata.get("namespace", KGS_DEFAULT_NS)}.{metadata["name"]}'
 
 
-def destroy_unless_exist_in(resources, is_dry_run):
-    manifest_ids = []
-    for resource in resources:
-        manifest_ids.append(_k8s_resource_id(resource.content["kind"], resource.content["metadata"]))
-    logger.info(f"existing manifests: {manifest_ids}")
+def state_id(state):
+    return _k8s_resource_id(state["kind"], state["metadata"])
 
-    logger.info("fetching resource kinds from k8s..")
-    cmd = ["kubectl", "api-resources", "-o", "name"]
-    outs, _, _ = utils.cmd_exec(cmd)
-    kinds = outs.decode().split()
-    kinds_csv = ",".join(kinds)
-    logger.info("fetched resource kinds from k8s.")
 
-    logger.info("fetching all resources from k8s..")
-    cmd = ["kubectl", "get", kinds_csv, "--all-namespaces", "-l", KGS_MANAGED_KEY + "=true", "-o", "json"]
-    # NOTE: ignore stderr because it contains the messages that is output even when command does not fail.
-    outs, _, _ = utils.cmd_exec(cmd)
-    logger.info("fetched all resources from k8s.")
+def state_requires(state):
+    requires = (state["metadata"].get("annotations") or {}).get(KGS_REQUIRES_KEY)
+    return set(requires.split(",")) if requires else set()
+
+
+@tracing.traced()
+def find_stale(resources, is_dry_run, k8s_client, discovery, inventory_name=inventory.INVENTORY_NAME):
+    manifest_ids = [r.id for r in resources]
+    logger.info(f"existing manifests: {manifest_ids}")
+
+    # NOTE: only the metadata are fetched, not to hold the whole objects (e.g. large secrets) in memory
+    selector, metadata_keys = KGS_MANAGED_KEY + "=true", [KGS_MANAGED_KEY, KGS_REQUIRES_KEY]
+    recorded = inventory.load(k8s_client, inventory_name)
+    if recorded is not None:
+        # only the kinds applied ever are fetched, one query for each kind
+        kinds = discovery.resolve(recorded)
+        logger.info(f"fetching {len(kinds)} kinds in the inventory from k8s..")
+        states = []
+        queries = [(api_version, kind, None, selector) for api_version, kind in kinds]
+        for kind_states in k8s_client.list_many(queries, metadata_keys):
+            states += kind_states or []
+        logger.info("fetched resources from k8s.")
+    else:
+        logger.info("fetching all resources from k8s..")
+        states = k8s_client.list_all(discovery.get_kinds(), selector, metadata_keys)
+        logger.info("fetched all resources from k8s.")
 
-    states = json.loads(outs.decode())["items"]
     states = _filter_states_by_label(states, KGS_MANAGED_KEY, "true")
-    logger.info(f'existing states: {[_k8s_resource_id(s["kind"], s["metadata"]) for s in states]}')
+    logger.info(f"existing states: {[state_id(s) for s in states]}")
 
+    manifest_ids = set(manifest_ids)
+    stale_states = []
     for state in states:
-        state_id = _k8s_resource_id(state["kind"], state["metadata"])
-        if state_id not in manifest_ids:
-            logger.info(f"{state_id} does not exist, it will be destroyed")
-            if is_dry_run:
-                logger.info("skipping delete a k8s resource (dry-run)")
-            else:
-                _delete_state(state)
+        id_str = state_id(state)
+        if id_str not in manifest_ids:
+            logger.info(f"{id_str} does not exist, it will be destroyed")
+            stale_states.append(state)
         else:
-            logger.info(f"{state_id} exists")
+            logger.info(f"{id_str} exists")
+
+    if recorded is None and not is_dry_run:
+        group_kinds = {inventory._group_kind(s["apiVersion"], s["kind"]) for s in states}
+        inventory.save(k8s_client, group_kinds, inventory_name)
+
+    return stale_states
+
+
+@tracing.traced(args=lambda states, *_: {"ids": [state_id(s) for s in states]})
+def destroy(states, is_dry_run, k8s_client):
+    if is_dry_run:
+        for state in states:
+            logger.info(f"skipping delete {state_id(state)} (dry-run)")
+        return []
+
+    # the objects of the same kind and namespace are deleted by one request
+    groups = {}
+    for state in states:
+        namespace = state["metadata"].get("namespace", KGS_DEFAULT_NS)
+        groups.setdefault((state["apiVersion"], state["kind"], namespace), []).append(state)
+    if not groups:
+        return []
+
+    requests = []
+    for (api_version, kind, namespace), group in groups.items():
+        logger.info(f"deleting {[state_id(s) for s in group]}")
+        requests.append((api_version, kind, namespace, [s["metadata"]["name"] for s in group]))
+
+    failed = []
+    for group, results in zip(groups.values(), k8s_client.delete_many(requests)):
+        for state, is_deleted in zip(group, results):
+            if is_deleted:
+                logger.info(f"deleted {state_id(state)}")
+            else:
+                logger.error(f"failed to delete {state_id(state)}")
+                failed.append(state)
+    metrics.inc("kgs_resources_total", len(states) - len(failed), applier="k8s", result="deleted")
+    metrics.inc("kgs_resources_total", len(failed), applier="k8s", result="failed")
+    return failed
 
 
 def _filter_states_by_label(states, labelkey, labelvalue):
@@ -145,17 +266,6 @@ def _filter_states_by_label(states, labelkey, labelvalue):
     return list(filter(_, states))
 
 
-def _delete_state(state):
-    resource_id = _k8s_resource_id(state["kind"], state["metadata"])
-    logger.info(f"deleting {resource_id}")
-    namespace = state["metadata"].get("namespace", KGS_DEFAULT_NS)
-    cmd = ["kubectl", "-n", namespace, "delete", state["kind"], state["metadata"]["name"]]
-    _, errs, _ = utils.cmd_exec(cmd)
-    if errs:
-        logger.error(f"failed to delete {resource_id}: {errs.decode()}")
-    logger.info(f"deleted {resource_id}")
-
-
 def _measure_k8s_operation():
     import timeit
     from pprint import pprint as pp
@@ -170,9 +280,7 @@ def _measure_k8s_operation():
 from k8s_gitsync import utils
 cmd = ["kubectl", "get", "{}", "--all-namespaces",
     "-l", "{}" + "=true", "-o", "json"]
-        """.format(
-            kind, KGS_MANAGED_KEY
-        )
+        """.format(kind, KGS_MANAGED_KEY)
         # NOTE: ignore stderr because it contains the messages that is output even when command does not fail.
         t = timeit.timeit("utils.cmd_exec(cmd)", setup, number=5)
         time_dict[kind] = t
@@ -0,0 +1,369 @@
+import os
+import ssl
+import json
+import queue
+import base64
+import tempfile
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse, urlencode, quote
+from . import yaml_codec
+from . import log
+
+logger = log.getLogger(__name__)
+
+FIELD_MANAGER = "k8s-gitsync"
+SERVICE_ACCOUNT_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+REQUEST_TIMEOUT = 60
+LIST_PAGE_SIZE = 500
+# NOTE: shorter than the socket timeout, the server closes an idle watch before the client gives up
+WATCH_TIMEOUT = REQUEST_TIMEOUT - 10
+# NOTE: the servers not supporting the metadata only response return the full objects instead
+PARTIAL_METADATA_ACCEPT = "application/json;as=PartialObjectMetadataList;v=v1;g=meta.k8s.io,application/json"
+
+
+def _find_named(entries, name):
+    for entry in entries or []:
+        if entry["name"] == name:
+            return entry
+    return {}
+
+
+def _load_cert_chain(ssl_context, user, basedir):
+    if "client-certificate-data" not in user and "client-certificate" not in user:
+        return
+
+    # NOTE: ssl module only loads certificates from files, so the inline data is written to temporary files.
+    paths = []
+    try:
+        for key in ["client-certificate", "client-key"]:
+            if f"{key}-data" in user:
+                with tempfile.NamedTemporaryFile(delete=False) as f:
+                    f.write(base64.b64decode(user[f"{key}-data"]))
+                paths.append(f.name)
+            else:
+                paths.append(str(basedir / user[key]))
+        ssl_context.load_cert_chain(paths[0], paths[1])
+    finally:
+        for key, path in zip(["client-certificate", "client-key"], paths):
+            if f"{key}-data" in user:
+                os.unlink(path)
+
+
+def load_kubeconfig(path=None, context_name=None):
+    # returns (server url, ssl context, headers, default namespace)
+    if path is None:
+        path = os.environ.get("KUBECONFIG", "").split(os.pathsep)[0] or os.path.expanduser("~/.kube/config")
+    if not os.path.exists(path) and os.environ.get("KUBERNETES_SERVICE_HOST"):
+        return _load_in_cluster_config()
+
+    basedir = Path(path).parent
+    config = yaml_codec.load(open(path))
+    context = _find_named(config.get("contexts"), context_name or config.get("current-context")).get("context", {})
+    cluster = _find_named(config.get("clusters"), context.get("cluster")).get("cluster", {})
+    user = _find_named(config.get("users"), context.get("user")).get("user", {})
+
+    ssl_context = ssl.create_default_context()
+    if cluster.get("insecure-skip-tls-verify"):
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    elif "certificate-authority-data" in cluster:
+        ssl_context.load_verify_locations(cadata=base64.b64decode(cluster["certificate-authority-data"]).decode())
+    elif "certificate-authority" in cluster:
+        ssl_context.load_verify_locations(cafile=str(basedir / cluster["certificate-authority"]))
+    _load_cert_chain(ssl_context, user, basedir)
+
+    headers = {}
+    if "token" in user:
+        headers["Authorization"] = f'Bearer {user["token"]}'
+    elif "tokenFile" in user:
+        headers["Authorization"] = f'Bearer {open(basedir / user["tokenFile"]).read().strip()}'
+    elif "username" in user:
+        credential = base64.b64encode(f'{user["username"]}:{user.get("password", "")}'.encode()).decode()
+        headers["Authorization"] = f"Basic {credential}"
+    elif "exec" in user or "auth-provider" in user:
+        logger.warning("exec and auth-provider credentials are not supported by api client, use kubectl client")
+
+    return cluster["server"], ssl_context, headers, context.get("namespace", "default")
+
+
+def _load_in_cluster_config():
+    host = os.environ["KUBERNETES_SERVICE_HOST"]
+    port = os.environ.get("KUBERNETES_SERVICE_PORT", "443")
+    ssl_context = ssl.create_default_context(cafile=os.path.join(SERVICE_ACCOUNT_DIR, "ca.crt"))
+    token = open(os.path.join(SERVICE_ACCOUNT_DIR, "token")).read().strip()
+    namespace = open(os.path.join(SERVICE_ACCOUNT_DIR, "namespace")).read().strip()
+    return f"https://{host}:{port}", ssl_context, {"Authorization": f"Bearer {token}"}, namespace
+
+
+class ConnectionPool:
+    def __init__(self, server, ssl_context, size):
+        self.url = urlparse(server)
+        self.ssl_context = ssl_context
+        self.size = size
+        self.idle = queue.LifoQueue()
+
+    def _connect(self):
+        if self.url.scheme == "https":
+            return http.client.HTTPSConnection(
+                self.url.hostname, self.url.port, context=self.ssl_context, timeout=REQUEST_TIMEOUT
+            )
+        return http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=REQUEST_TIMEOUT)
+
+    def _release(self, conn, response):
+        if response.will_close or self.idle.qsize() >= self.size:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+    def request(self, method, path, body=None, headers=None):
+        path = self.url.path.rstrip("/") + path
+        try:
+            conn, reused = self.idle.get_nowait(), True
+        except queue.Empty:
+            conn, reused = self._connect(), False
+
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            # NOTE: the server may have closed the idle keep-alive connection, retry once with a new one.
+            if not reused:
+                raise
+            conn = self._connect()
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            data = response.read()
+
+        self._release(conn, response)
+        return response.status, data
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+class ApiClient:
+    def __init__(self, server, ssl_context=None, headers=None, namespace="default", pool_size=4):
+        self.server = server
+        self.pool = ConnectionPool(server, ssl_context, pool_size)
+        self.headers = headers or {}
+        self.namespace = namespace
+        self.discovery = {}
+        self.discovery_lock = threading.Lock()
+
+    @classmethod
+    def from_kubeconfig(cls, path=None, context_name=None, pool_size=4):
+        server, ssl_context, headers, namespace = load_kubeconfig(path, context_name)
+        return cls(server, ssl_context, headers, namespace, pool_size)
+
+    def _request(self, method, path, body=None, content_type="application/json", params=None, accept=None):
+        if params:
+            path += "?" + urlencode(params)
+        headers = {"Accept": accept or "application/json", **self.headers}
+        if body is not None:
+            headers["Content-Type"] = content_type
+            body = json.dumps(body, default=str).encode()
+        status, data = self.pool.request(method, path, body, headers)
+        logger.debug(f"requested: {method} {path} -> {status}")
+        try:
+            return status, json.loads(data) if data else None
+        except ValueError:
+            return status, data.decode(errors="replace")
+
+    @staticmethod
+    def _group_version_path(api_version):
+        return "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+
+    def _discover(self, api_version):
+        status, resource_list = self._request("GET", self._group_version_path(api_version))
+        if status != 200:
+            return {}
+        # subresources (e.g. 'deployments/status') are not listed as kinds
+        return {r["kind"]: r for r in resource_list["resources"] if "/" not in r["name"]}
+
+    def _resource(self, api_version, kind):
+        with self.discovery_lock:
+            resources = self.discovery.get(api_version)
+            # the kind may be served after the discovery cached (e.g. CRD applied in this sync), so fetch again
+            if resources is None or kind not in resources:
+                resources = self.discovery[api_version] = self._discover(api_version)
+        return resources.get(kind)
+
+    def _path(self, api_version, kind, namespace=None, name=None):
+        resource = self._resource(api_version, kind)
+        if resource is None:
+            logger.warning(f"{kind} in {api_version} is not served by k8s")
+            return None
+
+        path = self._group_version_path(api_version)
+        if resource["namespaced"] and namespace is not None:
+            path += f"/namespaces/{quote(namespace)}"
+        path += f'/{resource["name"]}'
+        if name is not None:
+            path += f"/{quote(name)}"
+        return path
+
+    @staticmethod
+    def _error_message(status, response):
+        if isinstance(response, dict) and "message" in response:
+            return f'{status} {response["message"]}'
+        return str(status)
+
+    def probe(self):
+        try:
+            status, _ = self._request("GET", "/version")
+        except (http.client.HTTPException, OSError) as e:
+            logger.error(f"failed to connect k8s api: {e}")
+            return False
+        return status == 200
+
+    def cluster_id(self):
+        return self.server
+
+    def list_namespaces(self):
+        states = self.list("v1", "Namespace", None, "", metadata_keys=[])
+        return [s["metadata"]["name"] for s in states] if states is not None else None
+
+    def create_namespace(self, namespace):
+        body = {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": namespace}}
+        status, response = self._request("POST", "/api/v1/namespaces", body)
+        if status not in (201, 409):
+            logger.error(f"failed to create namespace {namespace}: {self._error_message(status, response)}")
+        return status in (201, 409)
+
+    def get(self, api_version, kind, namespace, name):
+        path = self._path(api_version, kind, namespace, name)
+        if path is None:
+            return None
+        status, response = self._request("GET", path)
+        if status != 200:
+            return None
+        return response
+
+    @staticmethod
+    def _metadata_only(item, metadata_keys):
+        # drop the other fields (e.g. managedFields, last-applied-configuration) not to keep them in memory
+        metadata = {k: item["metadata"][k] for k in ("name", "namespace") if k in item["metadata"]}
+        for field in ("labels", "annotations"):
+            values = item["metadata"].get(field) or {}
+            metadata[field] = {k: values[k] for k in metadata_keys if k in values}
+        return {"metadata": metadata}
+
+    def list(self, api_version, kind, namespace, label_selector, metadata_keys=None):
+        # metadata_keys: labels and annotations to be fetched, only the metadata are fetched when given
+        path = self._path(api_version, kind, namespace)
+        if path is None:
+            return None
+        accept = PARTIAL_METADATA_ACCEPT if metadata_keys is not None else None
+        params = {"labelSelector": label_selector, "limit": LIST_PAGE_SIZE}
+
+        # fetched page by page, so that a large list is not received at once
+        items = []
+        while True:
+            status, response = self._request("GET", path, params=params, accept=accept)
+            if status != 200:
+                logger.warning(f"failed to fetch {kind} in {namespace}: {self._error_message(status, response)}")
+                return None
+            for item in response["items"]:
+                if metadata_keys is not None:
+                    item = self._metadata_only(item, metadata_keys)
+                # NOTE: items in a list response does not have kind and apiVersion
+                item["apiVersion"] = api_version
+                item["kind"] = kind
+                items.append(item)
+            params["continue"] = response["metadata"].get("continue")
+            if not params["continue"]:
+                return items
+
+    def list_many(self, queries, metadata_keys=None):
+        # the requests are sent on the persistent connections one by one, that is cheap enough
+        return [self.list(*query, metadata_keys=metadata_keys) for query in queries]
+
+    def get_kinds(self):
+        api_versions = ["v1"]
+        status, group_list = self._request("GET", "/apis")
+        if status == 200:
+            api_versions += [g["preferredVersion"]["groupVersion"] for g in group_list["groups"]]
+
+        kinds = []
+        for api_version in api_versions:
+            resources = self._discover(api_version)
+            with self.discovery_lock:
+                self.discovery[api_version] = resources
+            kinds += [(api_version, kind) for kind, r in resources.items() if "list" in r.get("verbs", [])]
+        return kinds
+
+    def list_all(self, kinds, label_selector, metadata_keys=None):
+        items = []
+        for api_version, kind in kinds:
+            items += self.list(api_version, kind, None, label_selector, metadata_keys) or []
+        return items
+
+    def apply(self, manifests, dry_run=False):
+        results = []
+        for manifest in manifests:
+            namespace = manifest["metadata"].get("namespace", self.namespace)
+            path = self._path(manifest["apiVersion"], manifest["kind"], namespace, manifest["metadata"]["name"])
+            if path is None:
+                results.append(False)
+                continue
+
+            # server-side apply, the manifests are owned by k8s-gitsync so conflicts are forced
+            params = {"fieldManager": FIELD_MANAGER, "force": "true"}
+            if dry_run:
+                params["dryRun"] = "All"
+            status, response = self._request("PATCH", path, manifest, "application/apply-patch+yaml", params)
+            if status not in (200, 201):
+                logger.error(f'failed to apply {manifest["kind"]} {namespace}/{manifest["metadata"]["name"]}:')
+                logger.error(f"  {self._error_message(status, response)}")
+            results.append(status in (200, 201))
+        return results
+
+    def delete(self, api_version, kind, namespace, name):
+        path = self._path(api_version, kind, namespace, name)
+        if path is None:
+            return False
+        status, response = self._request("DELETE", path)
+        if status not in (200, 202, 404):
+            logger.error(f"failed to delete {kind} {namespace}/{name}: {self._error_message(status, response)}")
+            return False
+        return True
+
+    def delete_many(self, requests):
+        # requests: list of (api_version, kind, namespace, names), deleted concurrently on the pooled connections
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            futures = [
+                [executor.submit(self.delete, api_version, kind, namespace, name) for name in names]
+                for api_version, kind, namespace, names in requests
+            ]
+            return [[f.result() for f in request_futures] for request_futures in futures]
+
+    def watch(self, api_version, kind, label_selector, handler):
+        # handler(event_type, state) is called for each event until the stream is closed
+        path = self._path(api_version, kind)
+        if path is None:
+            return
+        params = {"labelSelector": label_selector, "watch": "true", "timeoutSeconds": WATCH_TIMEOUT}
+        path = self.pool.url.path.rstrip("/") + path + "?" + urlencode(params)
+
+        # a watch holds the connection while streaming, so a dedicated one is used instead of the pooled ones
+        conn = self.pool._connect()
+        try:
+            conn.request("GET", path, headers={"Accept": "application/json", **self.headers})
+            response = conn.getresponse()
+            if response.status != 200:
+                logger.warning(f"failed to watch {kind}: {self._error_message(response.status, response.read())}")
+                return
+            # the events are sent a line for each
+            for line in response:
+                event = json.loads(line)
+                handler(event["type"], event["object"])
+        except (http.client.HTTPException, OSError) as e:
+            logger.debug(f"watching {kind} is stopped: {e}")
+        finally:
+            conn.close()
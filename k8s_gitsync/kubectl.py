@@ -0,0 +1,259 @@
+import re
+import json
+import atexit
+import codecs
+import subprocess
+from collections import Counter
+from . import utils
+from . import yaml_codec
+from . import log
+
+logger = log.getLogger(__name__)
+
+FIELD_MANAGER = "k8s-gitsync"
+# --server-side with --field-manager, and --dry-run=server are supported from kubectl 1.18
+SERVER_SIDE_MIN_VERSION = (1, 18)
+
+
+class KubectlClient:
+    def __init__(self, kubectl_binary_path="kubectl", server_side=False):
+        self.kubectl_binary_path = kubectl_binary_path
+        self.server_side = server_side
+
+    def probe(self):
+        _, _, rc = utils.cmd_exec([self.kubectl_binary_path, "version"])
+        return rc == 0
+
+    def client_version(self):
+        # (major, minor) of kubectl, or None when unknown
+        outs, errs, rc = utils.cmd_exec([self.kubectl_binary_path, "version", "--client", "-o", "json"])
+        if rc != 0:
+            logger.warning(f"failed to fetch the kubectl version: {errs.decode()}")
+            return None
+        version = json.loads(outs.decode())["clientVersion"]
+        # NOTE: the minor version may have a suffix, e.g. "16+"
+        return int(version["major"]), int(re.match(r"\d+", version["minor"]).group())
+
+    def list_namespaces(self):
+        cmd = [self.kubectl_binary_path, "get", "namespaces", "-o", "jsonpath={.items[*].metadata.name}"]
+        outs, errs, rc = utils.cmd_exec(cmd)
+        if rc != 0:
+            logger.warning(f"failed to fetch namespaces: {errs.decode()}")
+            return None
+        return outs.decode().split()
+
+    def create_namespace(self, namespace):
+        cmd = [self.kubectl_binary_path, "create", "namespace", namespace]
+        _, errs, rc = utils.cmd_exec(cmd)
+        return rc == 0 or b"AlreadyExists" in errs
+
+    def get(self, api_version, kind, namespace, name):
+        cmd = [self.kubectl_binary_path, "-n", namespace, "get", kind, name, "-o", "json"]
+        outs, _, rc = utils.cmd_exec(cmd)
+        if rc != 0:
+            return None
+        return json.loads(outs.decode())
+
+    def cluster_id(self):
+        cmd = [self.kubectl_binary_path, "config", "view", "--minify", "-o", "jsonpath={.clusters[0].cluster.server}"]
+        outs, _, rc = utils.cmd_exec(cmd)
+        if rc != 0:
+            return None
+        return outs.decode().strip() or None
+
+    @staticmethod
+    def _kind_arg(api_version, kind):
+        # "<kind>.<version>.<group>" is not ambiguous among the groups serving the same kind
+        group, _, version = api_version.rpartition("/")
+        return f"{kind}.{version}.{group}" if group else kind
+
+    @staticmethod
+    def _output_args(metadata_keys):
+        if metadata_keys is None:
+            return ["-o", "json"]
+        # only the metadata are printed a line for each object, instead of the full JSON
+        fields = ["apiVersion", "kind", "metadata.namespace", "metadata.name"]
+        fields += [f"metadata.labels['{k}']" for k in metadata_keys]
+        fields += [f"metadata.annotations['{k}']" for k in metadata_keys]
+        columns = '{"\\t"}'.join("{." + f + "}" for f in fields)
+        return ["-o", "jsonpath={range .items[*]}" + columns + '{"\\n"}{end}']
+
+    @staticmethod
+    def _parse_metadata(outs, metadata_keys):
+        items = []
+        for line in outs.splitlines():
+            api_version, kind, namespace, name, *values = line.decode().split("\t")
+            metadata = {"name": name}
+            if namespace:
+                metadata["namespace"] = namespace
+            labels, annotations = values[: len(metadata_keys)], values[len(metadata_keys) :]
+            metadata["labels"] = {k: v for k, v in zip(metadata_keys, labels) if v}
+            metadata["annotations"] = {k: v for k, v in zip(metadata_keys, annotations) if v}
+            items.append({"apiVersion": api_version, "kind": kind, "metadata": metadata})
+        return items
+
+    def _list_cmd(self, api_version, kind, namespace, label_selector, metadata_keys=None):
+        ns_args = ["-n", namespace] if namespace is not None else ["--all-namespaces"]
+        kind_arg = self._kind_arg(api_version, kind)
+        return [
+            self.kubectl_binary_path,
+            *ns_args,
+            "get",
+            kind_arg,
+            "-l",
+            label_selector,
+            *self._output_args(metadata_keys),
+        ]
+
+    def _parse_list(self, kind, namespace, result, metadata_keys=None):
+        outs, errs, rc = result
+        if rc != 0:
+            logger.warning(f"failed to fetch {kind} in {namespace}: {errs.decode()}")
+            return None
+        if metadata_keys is not None:
+            return self._parse_metadata(outs, metadata_keys)
+        return json.loads(outs.decode())["items"]
+
+    def list(self, api_version, kind, namespace, label_selector, metadata_keys=None):
+        # metadata_keys: labels and annotations to be fetched, only the metadata are fetched when given
+        result = utils.cmd_exec(self._list_cmd(api_version, kind, namespace, label_selector, metadata_keys))
+        return self._parse_list(kind, namespace, result, metadata_keys)
+
+    def list_many(self, queries, metadata_keys=None):
+        # queries: list of (api_version, kind, namespace, label_selector), fetched concurrently
+        cmds = [(self._list_cmd(*query, metadata_keys), None) for query in queries]
+        results = utils.cmd_exec_all(cmds)
+        return [self._parse_list(q[1], q[2], result, metadata_keys) for q, result in zip(queries, results)]
+
+    def get_kinds(self):
+        # NOTE: SHORTNAMES column may be empty, so the columns are cut at the positions in the header
+        cmd = [self.kubectl_binary_path, "api-resources", "--verbs=list"]
+        outs, errs, rc = utils.cmd_exec(cmd)
+        lines = outs.decode().splitlines()
+        if not lines:
+            logger.error(f"failed to fetch resource kinds: {errs.decode()}")
+            return []
+        if rc != 0:
+            # e.g. an aggregated API is unavailable, the other kinds are still listed
+            logger.warning(f"some resource kinds may not be fetched: {errs.decode()}")
+
+        header = lines[0]
+        kind_at = header.index("KIND")
+        if "APIVERSION" in header:
+            api_version_at = header.index("APIVERSION")
+            kinds = []
+            for line in lines[1:]:
+                kinds.append((line[api_version_at:].split()[0], line[kind_at:].split()[0]))
+            return kinds
+
+        # NOTE: kubectl < 1.20 prints APIGROUP instead, which is empty for the core group
+        group_at, namespaced_at = header.index("APIGROUP"), header.index("NAMESPACED")
+        versions = self._preferred_versions()
+        kinds = []
+        for line in lines[1:]:
+            group, kind = line[group_at:namespaced_at].strip(), line[kind_at:].split()[0]
+            if not group:
+                kinds.append(("v1", kind))
+            elif group in versions:
+                kinds.append((versions[group], kind))
+            else:
+                logger.warning(f"the version of {group} is not found, {kind} is skipped")
+        return kinds
+
+    def _preferred_versions(self):
+        # group -> preferred group version, the versions listed by 'kubectl api-resources' of kubectl < 1.20
+        outs, errs, rc = utils.cmd_exec([self.kubectl_binary_path, "get", "--raw", "/apis"])
+        if rc != 0:
+            logger.error(f"failed to fetch API groups: {errs.decode()}")
+            return {}
+        return {g["name"]: g["preferredVersion"]["groupVersion"] for g in json.loads(outs.decode())["groups"]}
+
+    def list_all(self, kinds, label_selector, metadata_keys=None):
+        kind_args = [self._kind_arg(api_version, kind) for api_version, kind in kinds]
+        cmd = [self.kubectl_binary_path, "get", ",".join(kind_args), "--all-namespaces", "-l", label_selector]
+        cmd += self._output_args(metadata_keys)
+        # NOTE: ignore stderr because it contains the messages that is output even when command does not fail.
+        outs, _, _ = utils.cmd_exec(cmd)
+        if metadata_keys is not None:
+            return self._parse_metadata(outs, metadata_keys)
+        return json.loads(outs.decode())["items"]
+
+    def apply(self, manifests, dry_run=False):
+        cmd = [self.kubectl_binary_path, "apply", "-f", "-", "-o", "name"]
+        if self.server_side:
+            # the manifests are owned by k8s-gitsync, so the fields changed by others are taken over
+            cmd += ["--server-side", f"--field-manager={FIELD_MANAGER}", "--force-conflicts"]
+        if dry_run:
+            # validated and admitted by the server, but not persisted
+            cmd += ["--dry-run=server"]
+        outs, errs, _ = utils.cmd_exec(cmd, stdin=yaml_codec.dump_all(manifests).encode())
+        if errs:
+            logger.error(f"failed to execute kubectl apply, {errs.decode()}")
+
+        # NOTE: '-o name' prints "<kind>[.<group>]/<name>" for each applied object as soon as it is applied,
+        # so the objects that are not printed are failed to apply.
+        applied = Counter()
+        for line in outs.decode().splitlines():
+            kind_group, _, name = line.strip().partition("/")
+            applied[(kind_group.split(".")[0], name)] += 1
+
+        keys = [(m["kind"].lower(), m["metadata"]["name"]) for m in manifests]
+        requested = Counter(keys)
+        # objects sharing kind and name in other namespaces can not be distinguished by the output
+        return [applied[key] == requested[key] for key in keys]
+
+    def _delete_cmd(self, api_version, kind, namespace, names):
+        kind_arg = self._kind_arg(api_version, kind)
+        return [
+            self.kubectl_binary_path,
+            "-n",
+            namespace,
+            "delete",
+            kind_arg,
+            *names,
+            "--ignore-not-found",
+            "-o",
+            "name",
+        ]
+
+    def delete_many(self, requests):
+        # requests: list of (api_version, kind, namespace, names), a command for each request run concurrently
+        results = utils.cmd_exec_all([(self._delete_cmd(*request), None) for request in requests])
+
+        deleted_list = []
+        for (_, kind, namespace, names), (outs, errs, rc) in zip(requests, results):
+            if rc == 0:
+                deleted_list.append([True] * len(names))
+                continue
+            logger.error(f"failed to delete {kind} in {namespace}: {errs.decode()}")
+            # NOTE: '-o name' prints "<kind>[.<group>]/<name>" for each deleted object
+            deleted = {line.strip().partition("/")[2] for line in outs.decode().splitlines()}
+            deleted_list.append([name in deleted for name in names])
+        return deleted_list
+
+    def watch(self, api_version, kind, label_selector, handler):
+        # handler(event_type, state) is called for each event until the stream is closed
+        kind_arg = self._kind_arg(api_version, kind)
+        cmd = [self.kubectl_binary_path, "get", kind_arg, "--all-namespaces", "-l", label_selector]
+        cmd += ["--watch", "--output-watch-events", "-o", "json"]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        # NOTE: the watching threads are not joined at exit, so the process is killed by atexit
+        atexit.register(process.kill)
+
+        # NOTE: the events are printed as concatenated (and indented) JSON objects, not a line for each
+        decoder, text_decoder, buffer = json.JSONDecoder(), codecs.getincrementaldecoder("utf-8")(), ""
+        try:
+            for chunk in iter(lambda: process.stdout.read1(65536), b""):
+                buffer += text_decoder.decode(chunk)
+                while True:
+                    buffer = buffer.lstrip()
+                    try:
+                        event, end = decoder.raw_decode(buffer)
+                    except ValueError:
+                        break
+                    buffer = buffer[end:]
+                    handler(event["type"], event["object"])
+        finally:
+            atexit.unregister(process.kill)
+            process.kill()
+            process.wait()
@@ -1,10 +1,38 @@
 import os
 import logging
+import threading
+from contextlib import contextmanager
+
+_group = threading.local()
+_group_lock = threading.Lock()
+
+
+class _GroupingStreamHandler(logging.StreamHandler):
+    # NOTE: while a thread is inside grouped(), its records are held back and written together on exit,
+    #       so that the logs of the resources reconciled concurrently are not interleaved.
+    def emit(self, record):
+        records = getattr(_group, "records", None)
+        if records is None:
+            super().emit(record)
+        else:
+            records.append((self, record))
+
+
+@contextmanager
+def grouped():
+    _group.records = []
+    try:
+        yield
+    finally:
+        records, _group.records = _group.records, None
+        with _group_lock:
+            for handler, record in records:
+                handler.handle(record)
 
 
 def getLogger(name):
     formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s", "%Y/%m/%d %H:%M:%S")
-    handler = logging.StreamHandler()
+    handler = _GroupingStreamHandler()
     handler.setFormatter(formatter)
     logger = logging.getLogger(name)
     logger.addHandler(handler)
@@ -1,47 +1,215 @@
 import sys
+import time
 import argparse
-from toposort import toposort_flatten
+from contextlib import contextmanager
+from toposort import toposort, CircularDependencyError
+from .resource import Resource
 from . import utils
 from . import k8s
 from . import helm
+from . import executor
+from . import expansion
+from . import kubectl
+from . import kube_api
+from . import incremental
+from . import cache
+from . import inventory
+from . import namespace
+from . import watch
+from . import plan
+from . import shard
+from . import metrics
+from . import tracing
+from . import yaml_codec
 from . import log
 
 logger = log.getLogger(__name__)
 
+PHASE_METRIC = "kgs_phase_duration_seconds"
 
-def main():
-    cli_desc = "Synchronizing the states with the manifests of k8s/helm"
-    parser = argparse.ArgumentParser(description=cli_desc)
-    parser.add_argument("repo", help="manifests repository directory")
-    parser.add_argument("--clean", action="store_true", help="clean up the resources removed from manifests")
-    parser.add_argument("--list-id", action="store_true", help="show resource id list")
-    parser.add_argument("--bench-k8s-get", action="store_true", help="benchmark k8s get operation")
-    parser.add_argument("--dry-run", action="store_true", help="dry run (check differences only)")
-    conf = parser.parse_args()
 
-    # benchmark subcommand
-    if conf.bench_k8s_get:
-        k8s._measure_k8s_operation()
-        return
+@contextmanager
+def _phase(name):
+    with metrics.timer(PHASE_METRIC, phase=name), tracing.span(name, "phase"):
+        yield
 
-    # probe k8s
-    if not utils.probe_k8s():
-        logger.error("failed to connect k8s server")
-        sys.exit(1)
 
-    # find all manifest files
-    resources = utils.get_manifest_files(conf.repo)
+def _find_cycles(dep_graph):
+    # the ids which require themselves through the others
+    def _reaches(start):
+        seen, stack = set(), list(dep_graph[start])
+        while stack:
+            id_str = stack.pop()
+            if id_str == start:
+                return True
+            if id_str not in seen and id_str in dep_graph:
+                seen.add(id_str)
+                stack.extend(dep_graph[id_str])
+        return False
 
-    # preload k8s manifests and expand multi-document YAML
-    expanded_resources = []
+    return sorted(id_str for id_str in dep_graph if _reaches(id_str))
+
+
+def _toposort(dep_graph):
+    # the ids in the cycles, and the ones requiring them, are reported and left out instead of failing the run
+    levels = []
+    try:
+        for level_ids in toposort(dep_graph):
+            levels.append(level_ids)
+    except CircularDependencyError as e:
+        cycles = _find_cycles(e.data)
+        logger.error(f"circular requires, skipped: {cycles}")
+        logger.error(f"requiring the circular ones, skipped: {sorted(set(e.data) - set(cycles))}")
+    return levels
+
+
+def _arrange(resources, report_missing=False):
+    index = {}
+    duplicated = set()
     for resource in resources:
-        if resource.applier == "k8s":
-            expanded_resources.extend(k8s.expand_multi_document_file(resource))
-        if resource.applier == "helm":
-            expanded_resources.extend(helm.expand(resource))
-    resources = expanded_resources
+        if resource.id in index:
+            logger.error(f"{resource.id} is defined in both {index[resource.id].manifest} and {resource.manifest}")
+            duplicated.add(resource.id)
+        index[resource.id] = resource
+    for id_str in duplicated:
+        del index[id_str]
+
+    dep_graph = {}
+    for resource in index.values():
+        # NOTE: not 'requires - index.keys()', a set operation with the dict keys copies all of them
+        missing = {r for r in resource.requires if r not in index}
+        if missing and report_missing:
+            logger.warning(f"{resource.id} requires {sorted(missing)}, not found in the manifests")
+        dep_graph[resource.id] = resource.requires - missing
+    return [[index[id_str] for id_str in sorted(level_ids)] for level_ids in _toposort(dep_graph)]
+
+
+def _inventory_name(conf):
+    return conf.shard.inventory_name if conf.shard is not None else inventory.INVENTORY_NAME
+
+
+def _apply(levels, conf, k8s_client, k8s_state, helm_client, helm_state, namespace_registry):
+    resources = [r for level in levels for r in level]
+    # all namespaces are created before the first level, the appliers only check them afterwards
+    if not conf.dry_run:
+        namespaces = k8s.namespaces_of([r for r in resources if r.applier == "k8s"])
+        namespaces |= helm.namespaces_of([r for r in resources if r.applier == "helm"])
+        namespace_registry.ensure(namespaces)
+
+    failed = []
+    level_executor = executor.LevelExecutor(conf.jobs)
+    # the contents dropped by --low-memory are loaded again parsing each file once for the whole apply
+    with Resource.reloading():
+        for level in levels:
+            tasks = []
+            for chunk in level_executor.split([r for r in level if r.applier == "k8s"]):
+                tasks.append((k8s.create_or_update, (chunk, conf.dry_run, k8s_client, k8s_state, namespace_registry)))
+            for resource in level:
+                if resource.applier == "helm":
+                    tasks.append(
+                        (helm.create_or_update, (resource, conf.dry_run, helm_client, helm_state, namespace_registry))
+                    )
+                elif resource.applier != "k8s":
+                    logger.error(f"unknown resource applier: {resource.applier}")
+            for task_failed in level_executor.run(tasks):
+                failed.extend(task_failed)
+    level_executor.shutdown()
+    if not conf.dry_run:
+        kinds = {(r.api_version, r.kind) for r in resources if r.applier == "k8s"}
+        inventory.extend(k8s_client, kinds, _inventory_name(conf))
+    return failed
+
+
+def _destroy(k8s_states, helm_releases, conf, k8s_client, helm_client, helm_state):
+    # the stale resources are destroyed in the reverse order of the requires,
+    # so that the resources are not deleted while the others requiring them still exist.
+    stale = {k8s.state_id(s): ("k8s", s) for s in k8s_states}
+    stale.update({r[0]: ("helm", r) for r in helm_releases})
+    dep_graph = {}
+    for id_str, (applier, item) in stale.items():
+        requires = k8s.state_requires(item) if applier == "k8s" else item[3]
+        dep_graph[id_str] = {r for r in requires if r in stale}
+
+    failed = []
+    level_executor = executor.LevelExecutor(2)
+    for level_ids in reversed(_toposort(dep_graph)):
+        level = [stale[id_str] for id_str in sorted(level_ids)]
+        tasks = [
+            (k8s.destroy, ([s for a, s in level if a == "k8s"], conf.dry_run, k8s_client)),
+            (helm.destroy, ([r for a, r in level if a == "helm"], conf.dry_run, helm_client, helm_state)),
+        ]
+        for task_failed in level_executor.run(tasks):
+            failed.extend(task_failed)
+    level_executor.shutdown()
+    return failed
+
+
+def _watch(conf, k8s_client):
+    # the parsed manifests and the states are kept in memory, only the changed or drifted ones are applied
+    k8s_state, helm_state = {}, {}
+    helm_client = None
+    namespace_registry = namespace.NamespaceRegistry(k8s_client)
+
+    def fetch_state(resources):
+        nonlocal helm_client
+        if helm_client is None and any(r.applier == "helm" for r in resources):
+            helm_client = helm.HelmClient()
+        if helm_client is not None:
+            helm_state.clear()
+            helm_state.update(helm.get_state(helm_client, conf.helm_state, k8s_client))
+        namespace_registry.reset()
+        return k8s.get_state(k8s_client, [r for r in resources if r.applier == "k8s"])
+
+    def reconcile(resources):
+        if helm_client is None and any(r.applier == "helm" for r in resources):
+            fetch_state(resources)
+        with _phase("apply"):
+            failed = _apply(
+                _arrange(resources), conf, k8s_client, k8s_state, helm_client, helm_state, namespace_registry
+            )
+        metrics.set_value("kgs_last_sync_timestamp_seconds", time.time())
+        if conf.metrics_textfile is not None:
+            metrics.write_textfile(conf.metrics_textfile)
+        return failed
+
+    manifests = watch.ManifestIndex(conf.repo, conf.ignore, lambda f: expansion.expand([f], None, conf.low_memory))
+    state_watcher = watch.StateWatcher(k8s_client, k8s_state)
+    daemon = watch.Daemon(manifests, state_watcher, fetch_state, reconcile, conf.watch_interval, conf.resync_interval)
+    daemon.run()
+
+
+def _manifest_cache(conf):
+    if conf.no_cache:
+        return None
+    return cache.ManifestCache(conf.cache_dir, conf.cache_max_mb * 1024 * 1024)
+
+
+def _sync(conf, k8s_client):
+    # find all manifest files
+    with _phase("walk"):
+        files = utils.get_manifest_files(conf.repo, conf.ignore)
+
+    with _phase("expand"):
+        manifest_cache = _manifest_cache(conf)
+
+        # pick up the manifest files changed since the last synced commit, and the ones requiring them
+        sync = None
+        if conf.incremental and not conf.list_id:
+            sync = incremental.IncrementalSync(conf.repo, conf.state_file, "clean" if conf.clean else "apply")
+            resources = expansion.expand(sync.select(files), manifest_cache, conf.low_memory, conf.expand_workers)
+            if not conf.clean:
+                dependents = sync.select_dependents(files, resources)
+                resources += expansion.expand(dependents, manifest_cache, conf.low_memory, conf.expand_workers)
+        else:
+            resources = expansion.expand(files, manifest_cache, conf.low_memory, conf.expand_workers)
+
+        if manifest_cache is not None:
+            manifest_cache.save()
 
-    # preload helm manifests
+    # the stale resources are found with all resources, not to take the ones of the other shards as removed
+    all_resources = resources
+    if conf.shard is not None:
+        resources = conf.shard.select(resources)
 
     # list id subcommand
     if conf.list_id:
@@ -50,28 +218,273 @@ def main():
         return
 
     # arrange by dependencies
-    dep_graph = {r.id: r.requires for r in resources}
-    dep_sorted = toposort_flatten(dep_graph)
-    sorted_resources = []
-    for resource_id in dep_sorted:
-        resource = [r for r in resources if r.id == resource_id]
-        if len(resource) == 1:
-            sorted_resources.append(resource[0])
-    resources = sorted_resources
+    with _phase("toposort"):
+        # the resources of the other files are not expanded by the incremental sync
+        levels = _arrange(resources, report_missing=sync is None)
+        resources = [r for level in levels for r in level]
+
+    # removed resources are found from the last synced state, instead of scanning all states
+    removed = None
+    if conf.clean and sync is not None and not sync.is_full:
+        removed = sync.removed(resources)
+        logger.info(f"removed since the last synced commit: {[e['id'] for e in removed]}")
+
+    # helm client and release state are shared by the whole run
+    with _phase("state_fetch"):
+        helm_client, helm_state = None, None
+        if removed is not None:
+            need_helm = any(e["applier"] == "helm" for e in removed)
+        else:
+            need_helm = conf.clean or any(r.applier == "helm" for r in resources)
+        if need_helm:
+            helm_client = helm.HelmClient()
+            helm_state = helm.get_state(helm_client, conf.helm_state, k8s_client)
+
+        k8s_state, k8s_stale, helm_stale = None, [], []
+        if conf.server_side and not conf.clean and conf.plan_out is None:
+            logger.info("server-side apply, the k8s states are not fetched")
+        elif not conf.clean:
+            k8s_state = k8s.get_state(k8s_client, [r for r in resources if r.applier == "k8s"])
+        elif removed is not None:
+            k8s_stale, helm_stale = incremental.k8s_states(removed), incremental.helm_releases(removed)
+        else:
+            discovery = inventory.Discovery(k8s_client, None if conf.no_cache else conf.cache_dir, conf.discovery_ttl)
+            k8s_resources = [r for r in all_resources if r.applier == "k8s"]
+            is_dry_run = conf.dry_run or conf.plan_out is not None
+            k8s_stale = k8s.find_stale(k8s_resources, is_dry_run, k8s_client, discovery, _inventory_name(conf))
+            helm_stale = helm.find_stale([r for r in all_resources if r.applier == "helm"], helm_state)
+            if conf.shard is not None:
+                k8s_stale, helm_stale = conf.shard.select_stale(k8s_stale, helm_stale)
+
+    # the decisions are written for a later --plan-in run, nothing is applied
+    if conf.plan_out is not None:
+        if conf.clean:
+            plan_dict = plan.build_clean(k8s_client.cluster_id(), k8s_stale, helm_stale, helm_state or {})
+        else:
+            plan_dict = plan.build(k8s_client.cluster_id(), levels, k8s_state, helm_state or {}, conf.repo)
+        plan.write(conf.plan_out, plan_dict)
+        return
 
     # apply or clean
+    failed = []
     if not conf.clean:
-        for resource in resources:
-            if resource.applier == "k8s":
-                k8s.create_or_update(resource, conf.dry_run)
-            elif resource.applier == "helm":
-                helm.create_or_update(resource, conf.dry_run)
-            else:
-                logger.error(f"unknown resource applier: {resource.applier}")
+        with _phase("apply"):
+            namespace_registry = namespace.NamespaceRegistry(k8s_client)
+            failed += _apply(levels, conf, k8s_client, k8s_state, helm_client, helm_state, namespace_registry)
+    else:
+        with _phase("clean"):
+            failed += _destroy(k8s_stale, helm_stale, conf, k8s_client, helm_client, helm_state)
+    metrics.set_value("kgs_last_sync_timestamp_seconds", time.time())
+
+    if sync is not None and not conf.dry_run:
+        if failed:
+            logger.warning(f"{len(failed)} resources failed, the synced commit is not recorded")
+        else:
+            sync.save(resources)
+
+
+def _expand_planned(files, manifest_cache, conf):
+    # the manifest files failed to read (e.g. removed or broken since the plan) are skipped
+    try:
+        return expansion.expand(files, manifest_cache, workers=conf.expand_workers)
+    except Exception:
+        # NOTE: the errors raised in the expansion workers may not be the original ones, each file is read again
+        logger.info("failed to expand the planned manifest files, expanding them one by one")
+
+    resources = []
+    for f in files:
+        try:
+            resources += expansion.expand([f], manifest_cache)
+        except (OSError, yaml_codec.YAMLError) as e:
+            logger.error(f"failed to read {f.manifest}: {e}")
+    return resources
+
+
+def _run_plan(conf, k8s_client):
+    # only the planned actions are run, the states are not fetched again but checked optimistically
+    plan_dict = plan.load(conf.plan_in, k8s_client.cluster_id())
+    if plan_dict is None:
+        sys.exit(1)
+
+    with _phase("state_fetch"):
+        helm_client, helm_state = None, {}
+        if any(action["applier"] == "helm" for action in plan_dict["actions"]):
+            helm_client = helm.HelmClient()
+            helm_state = helm.get_revisions(helm_client)
+
+    if plan_dict["mode"] == "clean":
+        k8s_stale, helm_stale, conflicts = plan.stale(plan_dict, helm_state)
+        with _phase("clean"):
+            failed = _destroy(k8s_stale, helm_stale, conf, k8s_client, helm_client, helm_state)
+    else:
+        with _phase("expand"):
+            manifest_cache = _manifest_cache(conf)
+            resources = _expand_planned(plan.manifest_files(plan_dict, conf.repo), manifest_cache, conf)
+            if manifest_cache is not None:
+                manifest_cache.save()
+        # NOTE: the actions of the files failed to read are not found in the resources, and taken as the conflicts
+        levels, conflicts = plan.select(plan_dict, resources, helm_state)
+        with _phase("apply"):
+            namespace_registry = namespace.NamespaceRegistry(k8s_client)
+            failed = _apply(levels, conf, k8s_client, None, helm_client, helm_state, namespace_registry)
+    metrics.set_value("kgs_last_sync_timestamp_seconds", time.time())
+
+    if conflicts:
+        logger.error(f"{len(conflicts)} planned actions were not run, changed since the plan: {conflicts}")
+    if failed:
+        logger.error(f"{len(failed)} planned actions failed")
+    # the plan is not fully applied, e.g. to be planned again by CI
+    if conflicts or failed:
+        sys.exit(1)
+
+
+def main():
+    cli_desc = "Synchronizing the states with the manifests of k8s/helm"
+    parser = argparse.ArgumentParser(description=cli_desc)
+    parser.add_argument("repo", help="manifests repository directory")
+    parser.add_argument(
+        "--ignore", action="append", default=[], help="pattern of files to ignore, in addition to .kgsignore"
+    )
+    parser.add_argument("--clean", action="store_true", help="clean up the resources removed from manifests")
+    parser.add_argument("--list-id", action="store_true", help="show resource id list")
+    parser.add_argument("--bench-k8s-get", action="store_true", help="benchmark k8s get operation")
+    parser.add_argument("--bench-yaml", action="store_true", help="benchmark parsing and hashing the manifests")
+    parser.add_argument("--dry-run", action="store_true", help="dry run (check differences only)")
+    parser.add_argument(
+        "--helm-state",
+        choices=["helm", "secrets"],
+        default="helm",
+        help="how to fetch helm release state (secrets: decode helm 3 release secrets in one kubectl call)",
+    )
+    parser.add_argument(
+        "--k8s-client",
+        choices=["kubectl", "api"],
+        default="kubectl",
+        help="how to access k8s (api: kubeconfig based REST client with persistent connections)",
+    )
+    parser.add_argument(
+        "--server-side",
+        action="store_true",
+        help="apply by server-side apply in a request for each batch, the changes are detected by k8s "
+        "instead of fetching the states (--dry-run is validated by the server)",
+    )
+    parser.add_argument(
+        "--plan-out", default=None, help="file to write the planned actions to, instead of applying them"
+    )
+    parser.add_argument(
+        "--plan-in",
+        default=None,
+        help="file of the planned actions to run, without fetching the states (written by --plan-out)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard.parse,
+        default=None,
+        help="INDEX/COUNT, apply and clean only the slice of the namespaces (and the ones connected by requires)",
+    )
+    parser.add_argument(
+        "--incremental", action="store_true", help="process only the files changed since the last synced commit"
+    )
+    parser.add_argument(
+        "--state-file",
+        default=".k8s-gitsync-state.json",
+        help="file to record the last synced commit for --incremental",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="keep only the ids and hashes of the k8s manifests, and parse the changed ones again to apply",
+    )
+    parser.add_argument(
+        "--expand-workers",
+        type=int,
+        default=expansion.DEFAULT_WORKERS,
+        help="number of processes to parse and hash the manifests (parsed in process when the repository is small)",
+    )
+    parser.add_argument("--cache-dir", default=cache.DEFAULT_CACHE_DIR, help="directory of parsed manifests cache")
+    parser.add_argument("--cache-max-mb", type=int, default=256, help="size limit of parsed manifests cache")
+    parser.add_argument("--no-cache", action="store_true", help="do not use parsed manifests cache")
+    parser.add_argument(
+        "--discovery-ttl",
+        type=int,
+        default=inventory.DEFAULT_DISCOVERY_TTL,
+        help="seconds to keep the resource kinds served by k8s in the cache",
+    )
+    parser.add_argument("--watch", action="store_true", help="keep running, and apply the changed or drifted resources")
+    parser.add_argument(
+        "--watch-interval", type=float, default=watch.DEFAULT_INTERVAL, help="seconds between the checks of --watch"
+    )
+    parser.add_argument(
+        "--resync-interval",
+        type=float,
+        default=watch.DEFAULT_RESYNC_INTERVAL,
+        help="seconds between the full state fetches of --watch",
+    )
+    parser.add_argument("--metrics-port", type=int, default=None, help="port to serve Prometheus metrics on /metrics")
+    parser.add_argument(
+        "--metrics-textfile", default=None, help="file to write Prometheus metrics (e.g. for textfile collector)"
+    )
+    parser.add_argument("--trace", default=None, help="file to write the timeline of the commands (Chrome trace JSON)")
+    parser.add_argument("--jobs", type=int, default=4, help="number of resources reconciled concurrently")
+    parser.add_argument("--max-procs", type=int, default=None, help="number of kubectl/helm processes run at once")
+    parser.add_argument("--cmd-timeout", type=float, default=None, help="seconds to wait for a kubectl/helm command")
+    conf = parser.parse_args()
+    if conf.jobs < 1:
+        parser.error("--jobs must be 1 or more")
+    # NOTE: no command would ever run with no processes allowed
+    if (conf.max_procs if conf.max_procs is not None else utils.DEFAULT_MAX_PROCS) < 1:
+        parser.error("--max-procs (or KGS_MAX_PROCS) must be 1 or more")
+    if conf.watch and (conf.clean or conf.incremental or conf.list_id):
+        parser.error("--watch can not be used with --clean, --incremental or --list-id")
+    if conf.plan_in is not None and (conf.clean or conf.incremental or conf.list_id or conf.watch or conf.plan_out):
+        parser.error("--plan-in can not be used with --clean, --incremental, --list-id, --watch or --plan-out")
+    if conf.shard is not None and (conf.incremental or conf.watch or conf.plan_in):
+        parser.error("--shard can not be used with --incremental, --watch or --plan-in")
+    if conf.plan_out is not None and (conf.list_id or conf.watch):
+        parser.error("--plan-out can not be used with --list-id or --watch")
 
+    utils.configure_exec(conf.max_procs, conf.cmd_timeout)
+    if conf.trace is not None:
+        tracing.enable()
+
+    # benchmark subcommand
+    if conf.bench_k8s_get:
+        k8s._measure_k8s_operation()
+        return
+    if conf.bench_yaml:
+        yaml_codec._measure_yaml_operation(utils.get_manifest_files(conf.repo, conf.ignore))
+        return
+
+    if conf.k8s_client == "api":
+        k8s_client = kube_api.ApiClient.from_kubeconfig(pool_size=conf.jobs)
     else:
-        k8s.destroy_unless_exist_in(list(filter(lambda r: r.applier == "k8s", resources)), conf.dry_run)
-        helm.destroy_unless_exist_in(list(filter(lambda r: r.applier == "helm", resources)), conf.dry_run)
+        k8s_client = kubectl.KubectlClient(server_side=conf.server_side)
+
+    # probe k8s
+    if not k8s_client.probe():
+        logger.error("failed to connect k8s server")
+        sys.exit(1)
+    if conf.server_side and conf.k8s_client == "kubectl":
+        version = k8s_client.client_version()
+        if version is not None and version < kubectl.SERVER_SIDE_MIN_VERSION:
+            required = ".".join(map(str, kubectl.SERVER_SIDE_MIN_VERSION))
+            logger.error(f"--server-side requires kubectl {required} or later (found: {'.'.join(map(str, version))})")
+            sys.exit(1)
+
+    if conf.metrics_port is not None:
+        metrics.serve(conf.metrics_port)
+    try:
+        if conf.watch:
+            _watch(conf, k8s_client)
+        elif conf.plan_in is not None:
+            _run_plan(conf, k8s_client)
+        else:
+            _sync(conf, k8s_client)
+    finally:
+        if conf.metrics_textfile is not None:
+            metrics.write_textfile(conf.metrics_textfile)
+        if conf.trace is not None:
+            tracing.write(conf.trace)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+import os
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import log
+
+logger = log.getLogger(__name__)
+
+# name: (type, help), the summaries are exported as <name>_count and <name>_sum
+METRICS = {
+    "kgs_phase_duration_seconds": ("summary", "Time spent in each phase of a sync"),
+    "kgs_command_duration_seconds": ("summary", "Time spent in kubectl/helm/git commands"),
+    "kgs_command_failures_total": ("counter", "Number of commands exited with non-zero status"),
+    "kgs_resources_total": ("counter", "Number of resources checked, changed, applied, validated or failed"),
+    "kgs_last_sync_timestamp_seconds": ("gauge", "Unix time of the last finished sync"),
+}
+
+_values = {}
+_lock = threading.Lock()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def set_value(name, value, **labels):
+    with _lock:
+        _values[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        count, total = _values.get(key, (0, 0.0))
+        _values[key] = (count + 1, total + value)
+
+
+@contextmanager
+def timer(name, **labels):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+
+def _format(name, labels, value):
+    if not labels:
+        return f"{name} {value}"
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    label_str = ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped))
+    return f"{name}{{{label_str}}} {value}"
+
+
+def render():
+    with _lock:
+        values = dict(_values)
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        samples = sorted((labels, v) for (n, labels), v in values.items() if n == name)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            if metric_type == "summary":
+                lines.append(_format(name + "_count", labels, value[0]))
+                lines.append(_format(name + "_sum", labels, value[1]))
+            else:
+                lines.append(_format(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    # NOTE: replaced atomically, the textfile collector of node_exporter must not read a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(render())
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(port, addr=""):
+    server = ThreadingHTTPServer((addr, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"serving metrics on :{port}/metrics")
+    return server
@@ -0,0 +1,38 @@
+import threading
+from . import log
+
+logger = log.getLogger(__name__)
+
+
+class NamespaceRegistry:
+    # the namespaces are listed once in a run, and only the missing ones are created
+    def __init__(self, k8s_client):
+        self.k8s_client = k8s_client
+        self.existing = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.existing is None:
+            self.existing = set(self.k8s_client.list_namespaces() or [])
+            logger.debug(f"existing namespaces: {sorted(self.existing)}")
+
+    def ensure(self, namespaces):
+        with self.lock:
+            self._load()
+            for namespace in sorted(set(namespaces) - self.existing):
+                logger.info(f"creating namespace {namespace}")
+                if self.k8s_client.create_namespace(namespace):
+                    self.existing.add(namespace)
+                else:
+                    logger.error(f"failed to create namespace {namespace}")
+
+    def missing(self, namespaces):
+        # the namespaces not created yet, e.g. the objects in them can not be validated by a dry-run
+        with self.lock:
+            self._load()
+            return set(namespaces) - self.existing
+
+    def reset(self):
+        # the namespaces are listed again on the next ensure (e.g. deleted by others)
+        with self.lock:
+            self.existing = None
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+from .resource import Resource
+from . import k8s
+from . import helm
+from . import incremental
+from . import log
+
+logger = log.getLogger(__name__)
+
+# NOTE: bump this when the actions are changed (e.g. 2: the manifest paths are relative to the repository)
+PLAN_VERSION = 2
+
+
+def _apply_action(resource, level, k8s_state, helm_state, repo_dir):
+    action = {"action": "apply", "id": resource.id, "applier": resource.applier, "level": level}
+    # the plan may be run in another checkout of the repository
+    action["manifest"] = os.path.relpath(resource.manifest, repo_dir)
+    if resource.applier == "k8s":
+        state = k8s_state.get(resource.id)
+        action["hash"] = resource.hash
+        action["resourceVersion"] = state["metadata"].get("resourceVersion") if state is not None else None
+    if resource.applier == "helm":
+        state = helm_state.get(resource.id)
+        action["values"] = [os.path.relpath(v, repo_dir) for v in resource.values]
+        action["chart"] = resource.content["chart"]
+        action["hash"] = resource.content["values_hash"]
+        action["revision"] = state.get("revision") if state is not None else None
+    return action
+
+
+def _delete_action(entry, helm_state):
+    # entry: same as the resources recorded by the incremental sync, to be turned back into the stale states
+    action = {"action": "delete", **entry}
+    if entry["applier"] == "helm":
+        action["revision"] = helm_state.get(entry["id"], {}).get("revision")
+    return action
+
+
+def build(cluster_id, levels, k8s_state, helm_state, repo_dir):
+    # only the resources which would be installed or upgraded are planned
+    actions = []
+    for i, level in enumerate(levels):
+        for resource in level:
+            if resource.applier == "k8s" and not k8s._check_create_or_update(k8s_state, resource):
+                continue
+            if resource.applier == "helm" and not helm._check_create_or_upgrade(helm_state, resource.content):
+                continue
+            actions.append(_apply_action(resource, i, k8s_state, helm_state, repo_dir))
+    return {"version": PLAN_VERSION, "created": time.time(), "cluster": cluster_id, "mode": "apply", "actions": actions}
+
+
+def build_clean(cluster_id, k8s_stale, helm_stale, helm_state):
+    entries = []
+    for state in k8s_stale:
+        metadata = state["metadata"]
+        entries.append(
+            {
+                "id": k8s.state_id(state),
+                "applier": "k8s",
+                "requires": sorted(k8s.state_requires(state)),
+                "apiVersion": state["apiVersion"],
+                "kind": state["kind"],
+                "name": metadata["name"],
+                "namespace": metadata.get("namespace"),
+            }
+        )
+    for id_str, namespace, release_name, requires in helm_stale:
+        entries.append(
+            {
+                "id": id_str,
+                "applier": "helm",
+                "requires": sorted(requires),
+                "name": release_name,
+                "namespace": namespace,
+            }
+        )
+    actions = [_delete_action(e, helm_state) for e in entries]
+    return {"version": PLAN_VERSION, "created": time.time(), "cluster": cluster_id, "mode": "clean", "actions": actions}
+
+
+def write(path, plan):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=1)
+    logger.info(f"wrote the plan of {len(plan['actions'])} actions to {path}")
+
+
+def load(path, cluster_id):
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        logger.error(f"unsupported plan version: {plan.get('version')} (expected: {PLAN_VERSION})")
+        return None
+    if plan["cluster"] != cluster_id:
+        logger.error(f"the plan is made for another cluster: {plan['cluster']} (current: {cluster_id})")
+        return None
+    return plan
+
+
+def manifest_files(plan, repo_dir):
+    files = {}
+    for action in plan["actions"]:
+        if action["action"] == "apply" and action["manifest"] not in files:
+            manifest = os.path.join(repo_dir, action["manifest"])
+            values = [os.path.join(repo_dir, v) for v in action.get("values", [])]
+            files[action["manifest"]] = Resource(action["applier"], manifest, values=values)
+    return list(files.values())
+
+
+def _is_revision_changed(action, helm_state):
+    revision = helm_state.get(action["id"], {}).get("revision")
+    if revision != action["revision"]:
+        logger.error(f'{action["id"]}: revision changed since the plan ({action["revision"]} -> {revision})')
+        return True
+    return False
+
+
+def select(plan, resources, helm_state):
+    """Returns the levels of the planned resources, and the ids of the actions which can not be run.
+
+    The resources must be the same as planned, and the helm releases must be at the planned revisions.
+    The k8s objects get the planned resourceVersion, which is checked by k8s when applied.
+    """
+    resource_dict = {r.id: r for r in resources}
+    levels, conflicts = {}, []
+    for action in plan["actions"]:
+        resource = resource_dict.get(action["id"])
+        if resource is None:
+            logger.error(f'{action["id"]}: not found in {action["manifest"]}')
+            conflicts.append(action["id"])
+            continue
+
+        if resource.applier == "k8s":
+            is_changed = resource.hash != action["hash"]
+        else:
+            planned = (action["chart"], action["hash"])
+            is_changed = (resource.content["chart"], resource.content["values_hash"]) != planned
+        if is_changed:
+            logger.error(f'{action["id"]}: manifest changed since the plan')
+            conflicts.append(action["id"])
+            continue
+
+        if resource.applier == "helm" and _is_revision_changed(action, helm_state):
+            conflicts.append(action["id"])
+            continue
+        # NOTE: the resourceVersion is a precondition of the update, k8s rejects it if the object is changed
+        if resource.applier == "k8s" and action["resourceVersion"] is not None:
+            resource.content["metadata"]["resourceVersion"] = action["resourceVersion"]
+        levels.setdefault(action["level"], []).append(resource)
+    return [levels[i] for i in sorted(levels)], conflicts
+
+
+def stale(plan, helm_state):
+    # the k8s objects are deleted by name, the helm releases must be at the planned revisions
+    entries, conflicts = [], []
+    for action in plan["actions"]:
+        if action["applier"] == "helm" and _is_revision_changed(action, helm_state):
+            conflicts.append(action["id"])
+        else:
+            entries.append(action)
+    return incremental.k8s_states(entries), incremental.helm_releases(entries), conflicts
@@ -1,15 +1,118 @@
+import sys
+import threading
+from contextlib import contextmanager
+
+# the content is dropped, and loaded again from the manifest file when it is used
+_DROPPED = object()
+
+
 class Resource:
+    # NOTE: slotted, tens of thousands of resources are kept for the whole run
+    __slots__ = (
+        "applier",
+        "manifest",
+        "values",
+        "_content",
+        "hash",
+        "_id",
+        "_requires",
+        "doc_index",
+        "api_version",
+        "kind",
+        "namespace",
+        "name",
+    )
+    # applier: function to load the documents of a manifest file again, registered by the appliers
+    loaders = {}
+    # (applier, manifest): the documents loaded again, kept while reloading() to parse each file once
+    _reloaded = None
+    _reload_lock = threading.Lock()
+    # the attributes of an expanded resource, e.g. stored in the manifest cache or sent by the expansion workers
+    FIELDS = (
+        "applier",
+        "manifest",
+        "values",
+        "content",
+        "hash",
+        "id",
+        "requires",
+        "doc_index",
+        "api_version",
+        "kind",
+        "namespace",
+        "name",
+    )
+
     def __init__(self, applier, manifest, **kwargs):
         self.applier = applier
         self.manifest = manifest
         self.values = kwargs.get("values", [])
-        self.content = kwargs.get("content", None)
+        self._content = kwargs.get("content", None)
         self.hash = kwargs.get("hash", None)
         self.id = kwargs.get("id", None)
         self.requires = kwargs.get("requires", set())
+        # position of the document in the manifest file, and the metadata kept even when the content is dropped
+        self.doc_index = kwargs.get("doc_index", None)
+        self.api_version = kwargs.get("api_version", None)
+        self.kind = kwargs.get("kind", None)
+        self.namespace = kwargs.get("namespace", None)
+        self.name = kwargs.get("name", None)
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        # the ids are compared and hashed many times (e.g. requires, toposort), interned not to be duplicated
+        self._id = sys.intern(value) if value is not None else None
+
+    @property
+    def requires(self):
+        return self._requires
+
+    @requires.setter
+    def requires(self, value):
+        self._requires = {sys.intern(r) for r in value}
+
+    @property
+    def content(self):
+        if self._content is _DROPPED:
+            self._content = Resource._load_documents(self.applier, self.manifest)[self.doc_index]
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
+    @staticmethod
+    def _load_documents(applier, manifest):
+        with Resource._reload_lock:
+            if Resource._reloaded is None:
+                return Resource.loaders[applier](manifest)
+            key = (applier, manifest)
+            if key not in Resource._reloaded:
+                Resource._reloaded[key] = Resource.loaders[applier](manifest)
+            return Resource._reloaded[key]
+
+    @staticmethod
+    @contextmanager
+    def reloading():
+        # NOTE: the documents of a file are reloaded together (e.g. a changed bundle of many documents),
+        # so the parsed files are kept until the end, instead of parsing a file for each resource
+        Resource._reloaded = {}
+        try:
+            yield
+        finally:
+            Resource._reloaded = None
+
+    def drop_content(self):
+        # only the resources which can be loaded again are dropped
+        if self.applier in Resource.loaders:
+            self._content = _DROPPED
 
     def __str__(self):
-        return str(self.__dict__)
+        return str({name.lstrip("_"): getattr(self, name) for name in self.__slots__})
 
     def __repr__(self):
         return str(self)
@@ -0,0 +1,93 @@
+import hashlib
+import argparse
+from . import k8s
+from . import inventory
+from . import log
+
+logger = log.getLogger(__name__)
+
+
+def _namespace_of(kind, name, namespace):
+    # the namespace objects are in the shard of the objects in them
+    if kind == "Namespace":
+        return name
+    return namespace or k8s.KGS_DEFAULT_NS
+
+
+def _resource_namespace(resource):
+    if resource.applier == "helm":
+        return resource.namespace
+    return _namespace_of(resource.kind, resource.name, resource.namespace)
+
+
+class Shard:
+    """A slice of the repository, the resources are assigned by the namespaces and the requires.
+
+    The namespaces connected by the requires are a component, assigned by the hash of its first namespace,
+    so that the resources requiring each other are applied and cleaned by the same worker.
+    """
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.parents = {}
+        self.namespaces = {}
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    @property
+    def inventory_name(self):
+        # NOTE: each shard records its own inventory, not to overwrite the kinds recorded by the others
+        return f"{inventory.INVENTORY_NAME}-{self.index}-of-{self.count}"
+
+    def _find(self, namespace):
+        while namespace in self.parents:
+            namespace = self.parents[namespace]
+        return namespace
+
+    def _union(self, a, b):
+        a, b = self._find(a), self._find(b)
+        if a != b:
+            # the root is the first namespace of the component, not depending on the order of the resources
+            self.parents[max(a, b)] = min(a, b)
+
+    def _owns(self, component):
+        return int(hashlib.sha256(component.encode()).hexdigest(), 16) % self.count == self.index
+
+    def _owns_namespace(self, namespace, requires):
+        # the stale objects are not in the repository, but follow the components of the resources they required
+        components = [self._find(namespace)]
+        components += [self._find(self.namespaces[r]) for r in requires if r in self.namespaces]
+        return self._owns(min(components))
+
+    def select(self, resources):
+        # resources: all resources in the repository, the components must be the same among the shards
+        for resource in resources:
+            self.namespaces[resource.id] = _resource_namespace(resource)
+        for resource in resources:
+            for required in resource.requires:
+                if required in self.namespaces:
+                    self._union(self.namespaces[resource.id], self.namespaces[required])
+
+        selected = [r for r in resources if self._owns(self._find(self.namespaces[r.id]))]
+        logger.info(f"shard {self}: {len(selected)} of {len(resources)} resources")
+        return selected
+
+    def select_stale(self, k8s_states, helm_releases):
+        states = []
+        for state in k8s_states:
+            metadata = state["metadata"]
+            namespace = _namespace_of(state["kind"], metadata["name"], metadata.get("namespace"))
+            if self._owns_namespace(namespace, k8s.state_requires(state)):
+                states.append(state)
+        releases = [r for r in helm_releases if self._owns_namespace(r[1], r[3])]
+        return states, releases
+
+
+def parse(spec):
+    # e.g. "0/3", for the argument type
+    index, _, count = spec.partition("/")
+    if not (index.isdigit() and count.isdigit()) or not 0 <= int(index) < int(count):
+        raise argparse.ArgumentTypeError(f"invalid shard: {spec} (expected: INDEX/COUNT, 0 <= INDEX < COUNT)")
+    return Shard(int(index), int(count))
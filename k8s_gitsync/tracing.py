@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from . import log
+
+logger = log.getLogger(__name__)
+
+# NOTE: None unless --trace is given, every function here returns immediately then
+_events = None
+_lock = threading.Lock()
+_started = 0.0
+_thread_names = {}
+_lanes = set()
+
+
+def enable():
+    global _events, _started
+    _events, _started = [], time.perf_counter()
+
+
+def is_enabled():
+    return _events is not None
+
+
+def _now():
+    return (time.perf_counter() - _started) * 1e6
+
+
+def _record(name, cat, ts, dur, tid, args):
+    event = {"name": name, "cat": cat, "ph": "X", "ts": ts, "dur": dur, "pid": os.getpid(), "tid": tid}
+    if args:
+        event["args"] = args
+    with _lock:
+        _events.append(event)
+
+
+@contextmanager
+def span(name, cat="function", **args):
+    # args: shown in the trace viewer (e.g. resource ids), may be updated in the block (e.g. return code)
+    if _events is None:
+        yield args
+        return
+    thread = threading.current_thread()
+    _thread_names.setdefault(thread.ident, thread.name)
+    ts = _now()
+    try:
+        yield args
+    finally:
+        _record(name, cat, ts, _now() - ts, thread.ident, args)
+
+
+def traced(name=None, cat="function", args=None):
+    # args: function to make the span args from the call arguments, called only when tracing
+    def decorator(fn):
+        span_name = name or f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+
+        @functools.wraps(fn)
+        def wrapper(*fn_args, **fn_kwargs):
+            if _events is None:
+                return fn(*fn_args, **fn_kwargs)
+            with span(span_name, cat, **(args(*fn_args, **fn_kwargs) if args else {})):
+                return fn(*fn_args, **fn_kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def command_span(name, cmd):
+    # the commands overlap on the event loop thread, so each running command is put on a free lane
+    if _events is None:
+        yield {}
+        return
+    with _lock:
+        lane = min(set(range(len(_lanes) + 1)) - _lanes)
+        _lanes.add(lane)
+    args = {"argv": cmd}
+    ts = _now()
+    try:
+        yield args
+    finally:
+        _record(name, "command", ts, _now() - ts, f"cmd-{lane}", args)
+        with _lock:
+            _lanes.discard(lane)
+
+
+def write(path):
+    if _events is None:
+        return
+    with _lock:
+        events = list(_events)
+    pid = os.getpid()
+    for tid, name in _thread_names.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    logger.info(f"wrote {len(events)} trace events to {path}")
@@ -1,75 +1,118 @@
 import re
 import os
-from glob import glob
-from subprocess import Popen, PIPE
-from pathlib import Path
+import time
+import asyncio
+import threading
+from fnmatch import fnmatch
+from subprocess import PIPE
 from .resource import Resource
+from . import metrics
+from . import tracing
 from . import log
 
 logger = log.getLogger(__name__)
 
-
-def filter_directory_contains_file(files, pattern):
-    pattern_re = re.compile(pattern)
-    path_list = list(map(Path, files))
-    contains_dir_list = [p for p in path_list if pattern_re.match(p.name)]
-    logger.debug(f"list of directories contains charts: {contains_dir_list}")
-
-    result = []
-    for path in path_list:
-        is_path_contain_file = [contains_dir.parent in path.parents for contains_dir in contains_dir_list]
-        logger.debug(f"Checking that the directory contains charts: dir[{path}], charts[{is_path_contain_file}]")
-        if not any(is_path_contain_file):
-            result.append(str(path))
-
-    return result
-
-
-def get_manifest_files(repo_dir):
+IGNORE_FILE = ".kgsignore"
+CHART_FILE = "Chart.yaml"
+
+# NOTE: all commands run on one event loop thread, so the limit of concurrent processes is global
+DEFAULT_MAX_PROCS = int(os.environ.get("KGS_MAX_PROCS", "8"))
+_exec_conf = {"max_procs": DEFAULT_MAX_PROCS, "timeout": None}
+_exec_loop = None
+_exec_semaphore = None
+_exec_lock = threading.Lock()
+# options followed by a value, skipped to find the verb of a command for the metrics
+_VALUE_OPTIONS = {"-n", "--namespace", "-C", "--kubeconfig", "--context"}
+
+
+def _load_ignore_patterns(repo_dir):
+    path = os.path.join(repo_dir, IGNORE_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def _is_ignored(relpath, name, is_dir, patterns):
+    # gitignore like: 'dir/' matches only directories, 'a/b*' matches the path from the repo root
+    for pattern in patterns:
+        if pattern.endswith("/"):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip("/")
+        if "/" in pattern:
+            if fnmatch(relpath, pattern.lstrip("/")):
+                return True
+        elif fnmatch(name, pattern):
+            return True
+    return False
+
+
+def _walk_files(repo_dir, patterns):
+    # NOTE: the directories contain Chart.yaml are not descended, their files are used by helm
+    stack = [repo_dir]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        if any(e.name == CHART_FILE for e in entries):
+            logger.debug(f"skipping chart directory: {directory}")
+            continue
+
+        subdirs = []
+        for entry in entries:
+            # hidden files were not matched by glob("**/*"), keep skipping them
+            if entry.name.startswith("."):
+                continue
+            is_dir = entry.is_dir()
+            if patterns and _is_ignored(os.path.relpath(entry.path, repo_dir), entry.name, is_dir, patterns):
+                logger.debug(f"ignored: {entry.path}")
+                continue
+            if is_dir:
+                subdirs.append(entry.path)
+            else:
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+def get_manifest_files(repo_dir, ignore_patterns=(), verbose=True):
     helm_manifest_pattern = re.compile(r"(.*)\.helm$")
     helm_values_pattern = re.compile(r"(.*)\.values\.ya?ml$")
     k8s_pattern = re.compile(r"(.*)\.ya?ml$")
 
-    def _get_helm_file(files):
-        manifest_list = []
-        helm_match_list = [(f, helm_manifest_pattern.match(f)) for f in files if helm_manifest_pattern.match(f)]
-        values_match_list = [(f, helm_values_pattern.match(f)) for f in files if helm_values_pattern.match(f)]
-        for filename, helm_match in helm_match_list:
-            d = Resource("helm", filename)
-            d.values = [f for f, m in values_match_list if helm_match.group(1) == m.group(1)]
-            files.remove(filename)
-            for e in d.values:
-                files.remove(e)
-            manifest_list.append(d)
-        return files, manifest_list
-
-    def _get_k8s_file(files):
-        manifest_list = []
-        k8s_files = filter(k8s_pattern.match, files)
-        manifest_list.extend([Resource("k8s", f) for f in k8s_files])
-        for e in k8s_files:
-            files.remove(e)
-        return files, manifest_list
-
-    path = os.path.join(repo_dir, "**/*")
-    logger.info(f"begin to walk manifest from {path}")
-    files = glob(path, recursive=True)
-    logger.info(f"  target files:")
-    for filepath in files:
-        logger.info(f"    {filepath}")
-
-    files = filter_directory_contains_file(files, "Chart\\.yaml")
-
-    files[:], helm_manifest = _get_helm_file(files)
-    files[:], k8s_manifest = _get_k8s_file(files)
-
-    logger.info(f"detected k8s manifest files:")
+    patterns = _load_ignore_patterns(repo_dir) + list(ignore_patterns)
+    # NOTE: not verbose when the repository is walked repeatedly (e.g. --watch)
+    log_info = logger.info if verbose else logger.debug
+    log_info(f"begin to walk manifest from {repo_dir}")
+    log_info(f"  target files:")
+
+    helm_files, values_files, k8s_files = {}, {}, []
+    for filepath in _walk_files(repo_dir, patterns):
+        log_info(f"    {filepath}")
+        helm_match = helm_manifest_pattern.match(filepath)
+        values_match = helm_values_pattern.match(filepath)
+        if helm_match:
+            helm_files[helm_match.group(1)] = filepath
+        elif values_match:
+            values_files.setdefault(values_match.group(1), []).append(filepath)
+        elif k8s_pattern.match(filepath):
+            k8s_files.append(filepath)
+
+    helm_manifest = []
+    for stem, filepath in helm_files.items():
+        helm_manifest.append(Resource("helm", filepath, values=values_files.pop(stem, [])))
+    # the values files without a helm manifest are treated as k8s manifests
+    k8s_files += [f for files in values_files.values() for f in files]
+    k8s_manifest = [Resource("k8s", f) for f in k8s_files]
+
+    log_info(f"detected k8s manifest files:")
     for m in map(lambda x: x.manifest, k8s_manifest):
-        logger.info(f"  {m}")
-    logger.info(f"detected helm manifest files:")
+        log_info(f"  {m}")
+    log_info(f"detected helm manifest files:")
     for m in map(lambda x: (x.manifest, x.values), helm_manifest):
-        logger.info(f"  meta: {m[0]}")
-        logger.info(f"  values: {m[1]}")
+        log_info(f"  meta: {m[0]}")
+        log_info(f"  values: {m[1]}")
 
     manifests = []
     manifests.extend(k8s_manifest)
@@ -78,16 +121,85 @@ def get_manifest_files(repo_dir):
     return manifests
 
 
-def cmd_exec(cmd, stdin=None):
-    p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    outs, errs = p.communicate(stdin)
+def configure_exec(max_procs=None, timeout=None):
+    if max_procs is not None:
+        _exec_conf["max_procs"] = max_procs
+    if timeout is not None:
+        _exec_conf["timeout"] = timeout
+
+
+def _get_exec_loop():
+    global _exec_loop
+    with _exec_lock:
+        if _exec_loop is None:
+            _exec_loop = asyncio.new_event_loop()
+            threading.Thread(target=_exec_loop.run_forever, name="cmd-exec", daemon=True).start()
+    return _exec_loop
+
+
+def _run_on_exec_loop(coro):
+    future = asyncio.run_coroutine_threadsafe(coro, _get_exec_loop())
+    try:
+        return future.result()
+    except BaseException:
+        # e.g. KeyboardInterrupt, kill the running processes
+        future.cancel()
+        raise
+
+
+def _command_labels(cmd):
+    # e.g. ["kubectl", "-n", "app", "get", ...] -> command="kubectl", verb="get"
+    args = iter(cmd[1:])
+    verb = ""
+    for arg in args:
+        if arg in _VALUE_OPTIONS:
+            next(args, None)
+        elif not arg.startswith("-"):
+            verb = arg
+            break
+    return {"command": os.path.basename(cmd[0]), "verb": verb}
+
+
+async def cmd_exec_async(cmd, stdin=None, timeout=None):
+    global _exec_semaphore
+    if _exec_semaphore is None:
+        _exec_semaphore = asyncio.Semaphore(_exec_conf["max_procs"])
+    if timeout is None:
+        timeout = _exec_conf["timeout"]
+
+    labels = _command_labels(cmd)
+    async with _exec_semaphore:
+        with tracing.command_span(f'{labels["command"]} {labels["verb"]}', cmd) as span_args:
+            started = time.monotonic()
+            p = await asyncio.create_subprocess_exec(*cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            try:
+                outs, errs = await asyncio.wait_for(p.communicate(stdin), timeout)
+            except asyncio.TimeoutError:
+                p.kill()
+                await p.wait()
+                logger.error(f"timed out after {timeout}s: {cmd}")
+                outs, errs = b"", f"timed out after {timeout}s".encode()
+            except asyncio.CancelledError:
+                p.kill()
+                await p.wait()
+                raise
+            span_args["rc"] = p.returncode
+
+    metrics.observe("kgs_command_duration_seconds", time.monotonic() - started, **labels)
+    if p.returncode != 0:
+        metrics.inc("kgs_command_failures_total", **labels)
+
     log.command_result_debug(logger, cmd, outs, errs)
     return outs, errs, p.returncode
 
 
-def probe_k8s():
-    _, _, rc = cmd_exec(["kubectl", "version"])
-    if rc == 0:
-        return True
-    else:
-        return False
+def cmd_exec(cmd, stdin=None, timeout=None):
+    return _run_on_exec_loop(cmd_exec_async(cmd, stdin, timeout))
+
+
+def cmd_exec_all(cmds, timeout=None):
+    # cmds: list of (cmd, stdin), results are in the same order
+    async def _exec_all():
+        return await asyncio.gather(*[cmd_exec_async(cmd, stdin, timeout) for cmd, stdin in cmds])
+
+    return _run_on_exec_loop(_exec_all())
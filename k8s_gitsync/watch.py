@@ -0,0 +1,162 @@
+import os
+import time
+import threading
+from . import utils
+from . import k8s
+from . import log
+
+logger = log.getLogger(__name__)
+
+DEFAULT_INTERVAL = 5
+DEFAULT_RESYNC_INTERVAL = 600
+WATCH_RETRY_INTERVAL = 5
+
+
+def _file_stats(resource):
+    stats = []
+    for path in [resource.manifest] + list(resource.values):
+        try:
+            s = os.stat(path)
+            stats.append((s.st_size, s.st_mtime_ns))
+        except OSError:
+            stats.append(None)
+    return stats
+
+
+class ManifestIndex:
+    # the expanded resources are kept in memory for each manifest file,
+    # and the files are polled by their stats to expand only the changed ones.
+    def __init__(self, repo_dir, ignore_patterns, expand_fn):
+        self.repo_dir = repo_dir
+        self.ignore_patterns = ignore_patterns
+        self.expand_fn = expand_fn
+        self.entries = {}
+        # key: stats of the files failed to expand, not to be expanded again until they are changed
+        self.failed = {}
+
+    def refresh(self):
+        # returns True when some files are added, changed or removed
+        entries, failed = {}, {}
+        for f in utils.get_manifest_files(self.repo_dir, self.ignore_patterns, verbose=False):
+            key = (f.applier, f.manifest, tuple(f.values))
+            stats = _file_stats(f)
+            entry = self.entries.get(key)
+            if (entry is None or entry[0] != stats) and self.failed.get(key) != stats:
+                logger.info(f"manifest changed: {f.manifest}")
+                try:
+                    entry = (stats, self.expand_fn(f))
+                except Exception:
+                    # NOTE: a broken manifest (e.g. YAML syntax error) does not stop the others,
+                    # the last good one is kept
+                    logger.exception(f"failed to expand {f.manifest}, the last expanded resources (if any) are kept")
+                    failed[key] = stats
+            elif key in self.failed:
+                failed[key] = self.failed[key]
+            if entry is not None:
+                entries[key] = entry
+
+        changed = entries.keys() != self.entries.keys() or any(entries[k] is not self.entries[k] for k in entries)
+        self.entries, self.failed = entries, failed
+        return changed
+
+    @property
+    def resources(self):
+        return [r for _, resources in self.entries.values() for r in resources]
+
+
+class StateWatcher:
+    # the live states of the managed objects are kept up to date by k8s watch streams,
+    # the objects deleted or changed by others are reported as drifted.
+    def __init__(self, k8s_client, state_dict):
+        self.k8s_client = k8s_client
+        self.state_dict = state_dict
+        self.kinds = set()
+        self.drifted = set()
+        self.lock = threading.Lock()
+
+    def watch(self, kinds):
+        for api_version, kind in sorted(set(kinds) - self.kinds):
+            self.kinds.add((api_version, kind))
+            threading.Thread(target=self._run, args=(api_version, kind), daemon=True).start()
+
+    def _run(self, api_version, kind):
+        while True:
+            logger.debug(f"watching {kind} in {api_version}")
+            try:
+                self.k8s_client.watch(api_version, kind, k8s.KGS_MANAGED_KEY + "=true", self._handle)
+            except Exception as e:
+                # NOTE: the thread must not die, the drift of the kind would never be seen again
+                logger.error(f"failed to watch {kind} in {api_version}: {e!r}")
+            time.sleep(WATCH_RETRY_INTERVAL)
+
+    def _handle(self, event_type, state):
+        # NOTE: BOOKMARK and ERROR (e.g. the resource version is too old) are not the object changes
+        if event_type not in ("ADDED", "MODIFIED", "DELETED"):
+            return
+        id_str = k8s.state_id(state)
+        with self.lock:
+            previous = self.state_dict.get(id_str)
+            if event_type == "DELETED":
+                self.state_dict.pop(id_str, None)
+                self.drifted.add(id_str)
+            else:
+                self.state_dict[id_str] = state
+                if previous is not None and k8s.applied_hash(previous) != k8s.applied_hash(state):
+                    self.drifted.add(id_str)
+
+    def replace(self, state_dict):
+        with self.lock:
+            self.state_dict.clear()
+            self.state_dict.update(state_dict)
+            self.drifted.clear()
+
+    def pop_drifted(self):
+        with self.lock:
+            drifted, self.drifted = self.drifted, set()
+        return drifted
+
+
+class Daemon:
+    def __init__(self, manifests, state_watcher, fetch_state, reconcile, interval, resync_interval):
+        self.manifests = manifests
+        self.state_watcher = state_watcher
+        # fetch_state(resources): fetches the states of k8s and helm, and returns the k8s states
+        # reconcile(resources): applies the resources differ from the states, and returns the failed ones
+        self.fetch_state = fetch_state
+        self.reconcile = reconcile
+        self.interval = interval
+        self.resync_interval = resync_interval
+
+    def run(self):
+        # retry: reconcile on the next interval even if nothing is changed, after an error
+        self.last_resync, self.failed, self.retry = None, [], False
+        while True:
+            started = time.monotonic()
+            try:
+                self._run_once(started)
+            except Exception:
+                # NOTE: the daemon keeps running, e.g. a failed helm list or kubectl command is retried
+                logger.exception("failed to reconcile, retrying on the next interval")
+                self.retry = True
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    def _run_once(self, started):
+        changed = self.manifests.refresh()
+        resources = self.manifests.resources
+        self.state_watcher.watch({(r.api_version, r.kind) for r in resources if r.applier == "k8s"})
+
+        # NOTE: the full states are fetched again sometimes, the watch streams may miss the events
+        resync = self.last_resync is None or started - self.last_resync >= self.resync_interval
+        if resync:
+            logger.info("fetching the full states")
+            self.state_watcher.replace(self.fetch_state(resources))
+            self.last_resync = started
+        drifted = self.state_watcher.pop_drifted()
+        if drifted:
+            logger.info(f"drifted: {sorted(drifted)}")
+
+        # the failed resources are retried on the next interval
+        if changed or drifted or resync or self.failed or self.retry:
+            self.failed = self.reconcile(resources)
+            self.retry = False
+            logger.info(f"reconciled in {time.monotonic() - started:.2f}s, {len(self.failed)} failed")
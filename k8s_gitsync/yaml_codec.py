@@ -0,0 +1,60 @@
+import yaml
+from . import log
+
+logger = log.getLogger(__name__)
+
+# NOTE: libyaml based loader and dumper are much faster, but PyYAML may be installed without libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+YAMLError = yaml.YAMLError
+
+
+def load(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def load_all(stream):
+    return yaml.load_all(stream, Loader=SafeLoader)
+
+
+def dump(data):
+    return yaml.dump(data, Dumper=SafeDumper)
+
+
+def dump_all(documents):
+    return yaml.dump_all(documents, Dumper=SafeDumper)
+
+
+def legacy_dump(data):
+    # NOTE: the legacy resource hash was sha256 of this output, libyaml folds long double-quoted scalars
+    #       differently from the pure python emitter, so it must not be replaced with the codec dumper.
+    return yaml.dump(data)
+
+
+def _measure_yaml_operation(resources):
+    import timeit
+    import hashlib
+    from . import hashing
+    from pprint import pprint as pp
+
+    documents = [open(r.manifest).read() for r in resources if r.applier == "k8s"]
+    parsed = [[d for d in yaml.load_all(s, Loader=yaml.SafeLoader) if d is not None] for s in documents]
+    logger.info(f"libyaml: {yaml.__with_libyaml__}, files: {len(documents)}, documents: {sum(map(len, parsed))}")
+
+    def _parse(loader):
+        return lambda: [list(yaml.load_all(s, Loader=loader)) for s in documents]
+
+    def _hash(dumper):
+        return lambda: [hashlib.sha256(yaml.dump(d, Dumper=dumper).encode()).hexdigest() for p in parsed for d in p]
+
+    time_dict = {
+        "parse (pure python)": timeit.timeit(_parse(yaml.SafeLoader), number=3) / 3,
+        "parse (codec)": timeit.timeit(_parse(SafeLoader), number=3) / 3,
+        "hash (legacy dump)": timeit.timeit(_hash(yaml.Dumper), number=3) / 3,
+        "hash (canonical)": timeit.timeit(lambda: [hashing.canonical_hash(d) for p in parsed for d in p], number=3) / 3,
+        "dump (codec)": timeit.timeit(_hash(SafeDumper), number=3) / 3,
+    }
+    pp(time_dict)